@@ -0,0 +1,300 @@
+import concurrent.futures
+import io
+import os
+import time
+import traceback
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+
+from PIL import Image
+
+from PolaroidBuilder import PolaroidSource, iter_polaroid_variants, get_transpose_method, transposed_size, get_layout_plan, iter_output_sizes, generate_polaroid_from_url, warm_up
+from PolaroidSettings import ColorMode, PolaroidMode
+from StreamingRenderer import write_polaroid_streamed
+from Encoders import get_encoder
+from Instrumentation import CollectingSink, JsonlSink, set_sink, stage
+
+# Bytes Pillow keeps in memory per pixel, 3 channel modes are stored padded to 4 bytes
+MODE_BYTES_PER_PIXEL = {"1": 1, "L": 1, "P": 1, "I;16": 2, "LA": 4, "PA": 4, "RGB": 4, "RGBA": 4, "RGBX": 4, "CMYK": 4, "YCbCr": 4, "LAB": 4, "HSV": 4, "I": 4, "F": 4}
+# Interpreter, fonts, encoder buffers and the small strips used while composing
+JOB_MEMORY_OVERHEAD = 64 * 1024 * 1024
+# Full size copies of the rendered source a blur engine holds while it blurs: the gaussian output, and for box the
+# array copy of the image, the horizontal pass, the output and the image made from it. pyramid blurs a reduced copy
+BLUR_ENGINE_COPIES = {"gaussian": 1, "box": 4}
+# Inputs from this many megapixels on are streamed to the output file instead of rendered in memory
+STREAMING_MEGAPIXELS = 200
+
+
+def use_streaming(job:dict, megapixels:float) -> bool:
+    # the streaming renderer only writes PNG
+    return (not job.get("max_output_size") and job.get("format", "png") == "png"
+            and megapixels >= job.get("stream_megapixels", STREAMING_MEGAPIXELS))
+
+
+def get_job_encoder(job:dict):
+    return get_encoder(job.get("format", "png"), **job.get("encoder_settings", {}))
+
+
+def get_output_file_name(image:str, polaroid_type:PolaroidMode, color_mode:ColorMode, extension:str = ".png", suffix:str = "") -> str:
+    return image.split("/")[-1].replace(".jpg", "") + "_" + polaroid_type.name + "_" + color_mode.name + suffix + extension
+
+
+def get_output_path(job:dict, polaroid_type:PolaroidMode, color_mode:ColorMode, extension:str = ".png", suffix:str = "") -> str:
+    # a job spec may name its one output file, the extra sizes are written next to it
+    if job.get("output"):
+        return os.path.splitext(job["output"])[0] + suffix + extension if suffix else job["output"]
+    return os.path.join(job.get("output_dir", "./output"), get_output_file_name(job["image"], polaroid_type, color_mode, extension, suffix))
+
+
+def parse_output_size(spec) -> dict:
+    # "web:2048" or "thumb:400:jpeg" (name:long edge in px[:format]), a dict {"name", "size", "format", "encoder_settings"} is kept
+    if isinstance(spec, dict):
+        if not isinstance(spec.get("name"), str) or not isinstance(spec.get("size"), int) or spec["size"] < 1:
+            raise ValueError("Output size needs a name and a positive integer size, got " + repr(spec))
+        if "format" in spec:
+            get_encoder(str(spec["format"]))
+        return spec
+    parts = str(spec).split(":")
+    if len(parts) not in (2, 3) or not parts[0] or not parts[1].isdigit() or int(parts[1]) < 1:
+        raise ValueError("Output size must be name:long_edge[:format], got " + str(spec))
+    size = {"name": parts[0], "size": int(parts[1])}
+    if len(parts) == 3:
+        get_encoder(parts[2])
+        size["format"] = parts[2]
+    return size
+
+
+def get_variant_outputs(job:dict, polaroid_type:PolaroidMode, color_mode:ColorMode) -> list:
+    # [(long edge, encoder, output path)] largest first, the full render (long edge None) and then job["sizes"].
+    # a size in the job's format keeps its encoder settings
+    encoder = get_job_encoder(job)
+    outputs = [(None, encoder, get_output_path(job, polaroid_type, color_mode, encoder.extension))]
+    for size in sorted(map(parse_output_size, job.get("sizes", ())), key=lambda size: size["size"], reverse=True):
+        format = size.get("format", job.get("format", "png"))
+        settings = dict(job.get("encoder_settings", {}) if format == job.get("format", "png") else {}, **size.get("encoder_settings", {}))
+        size_encoder = get_encoder(format, **settings)
+        outputs.append((size["size"], size_encoder, get_output_path(job, polaroid_type, color_mode, size_encoder.extension, "_" + size["name"])))
+    return outputs
+
+
+def encode_outputs(outputs:list, output_image:Image.Image, encoded:dict = None) -> list:
+    # every size is reduced from the one before it, so the extra outputs cost a fraction of the render.
+    # with an encoded dict the files are not written, their bytes are stored in it by output path
+    written = []
+    for (_, encoder, output_path), (_, image) in zip(outputs, iter_output_sizes(output_image, [long_edge for long_edge, _, _ in outputs])):
+        target = io.BytesIO() if encoded is not None else output_path
+        with stage("encode", format=encoder.format):
+            encoder.encode(image, target)
+        if encoded is not None:
+            encoded[output_path] = target.getvalue()
+        written.append(output_path)
+    return written
+
+
+def get_job_source(job:dict):
+    # the image path, or a file over the bytes a storage backend already read into job["data"]
+    return io.BytesIO(job["data"]) if job.get("data") is not None else job["image"]
+
+
+def write_streamed_variants(job:dict, im:Image.Image, encoded:dict = None) -> list:
+    # every variant of the job streamed straight to its output, returns the written paths (see render_job for encoded)
+    source = PolaroidSource(im)
+    written = []
+    for polaroid_type in job["types"]:
+        for color_mode in job["colors"]:
+            outputs = get_variant_outputs(job, polaroid_type, color_mode)
+            with io.BytesIO() if encoded is not None else open(outputs[0][2], "wb") as fp:
+                write_polaroid_streamed(source, polaroid_type, color_mode, fp, job.get("blur_engine", "pyramid"))
+                if encoded is not None:
+                    encoded[outputs[0][2]] = fp.getvalue()
+            written.append(outputs[0][2])
+            if len(outputs) > 1:
+                # the streamed render is never held in memory, the extra sizes come from a draft decoded render at the largest of them
+                reduced = generate_polaroid_from_url(get_job_source(job), polaroid_type, color_mode, job.get("blur_engine", "pyramid"), outputs[1][0])
+                written += encode_outputs(outputs[1:], reduced, encoded)
+    return written
+
+
+def render_job(job:dict) -> dict:
+    # job: {"image": path, "types": [PolaroidMode], "colors": [ColorMode], "output_dir": path, "format": "png"}, "sizes" adds reduced outputs (see parse_output_size)
+    # optional "blur_engine" (see PolaroidBuilder.BLUR_ENGINES), with "instrument" the stage timings come back in result["stages"], with "trace" they are appended to that JSONL file.
+    # with "return_encoded" nothing is written, result["encoded"] maps every output path to its bytes (see Storage.iter_storage_batch)
+    sink = CollectingSink(track_memory=bool(job.get("trace"))) if job.get("instrument") or job.get("trace") else None
+    previous_sink = set_sink(sink) if sink else None
+    start = time.perf_counter()
+    result = {"image": job["image"], "outputs": [], "megapixels": 0.0, "seconds": 0.0, "error": None}
+    if "id" in job:
+        result["id"] = job["id"]
+    encoded = dict() if job.get("return_encoded") else None
+    try:
+        with Image.open(get_job_source(job)) as im:
+            result["megapixels"] = im.width * im.height / 1000000
+            if use_streaming(job, result["megapixels"]):
+                result["outputs"] += write_streamed_variants(job, im, encoded)
+            else:
+                for (polaroid_type, color_mode), output_image in iter_polaroid_variants(im, job["types"], job["colors"], job.get("blur_engine", "pyramid"), job.get("max_output_size"), draft=True):
+                    result["outputs"] += encode_outputs(get_variant_outputs(job, polaroid_type, color_mode), output_image, encoded)
+        if encoded is not None:
+            result["encoded"] = encoded
+    except Exception as e:
+        result["error"] = repr(e)
+        result["traceback"] = traceback.format_exc()
+    finally:
+        if sink:
+            set_sink(previous_sink)
+    result["seconds"] = time.perf_counter() - start
+    if sink:
+        result["stages"] = sink.get_stage_timings()
+        if job.get("trace"):
+            trace = JsonlSink(job["trace"])
+            for event in sink.events:
+                trace.record(dict(event, image=job["image"]))
+    return result
+
+
+def estimate_peak_memory(job:dict) -> int:
+    # reads only the image header: the decoded source plus the largest canvas alive at the same time
+    try:
+        with Image.open(get_job_source(job)) as im:
+            bytes_per_pixel = MODE_BYTES_PER_PIXEL.get(im.mode, 4)
+            photo_size = transposed_size(im.size, get_transpose_method(im))
+            source_pixels = im.width * im.height
+            is_jpeg = im.format == "JPEG"
+    except Exception:
+        return JOB_MEMORY_OVERHEAD
+
+    canvas_pixels = 0
+    # the burst background blurs the whole rendered source next to everything else
+    blur_copies = 0
+    if any(get_layout_plan(polaroid_type, photo_size).burst_background for polaroid_type in job["types"]):
+        blur_copies = BLUR_ENGINE_COPIES.get(job.get("blur_engine", "pyramid"), 0)
+    if job.get("max_output_size"):
+        render_pixels = min(source_pixels, job["max_output_size"] ** 2)
+        if is_jpeg:
+            # draft mode decodes at most twice the render size in each direction
+            source_pixels = min(source_pixels, 4 * job["max_output_size"] ** 2)
+        else:
+            # every other format is decoded at full size and resized to the render size next to it
+            source_pixels += render_pixels
+        return (source_pixels + job["max_output_size"] ** 2 + render_pixels * blur_copies) * bytes_per_pixel + JOB_MEMORY_OVERHEAD
+    if use_streaming(job, source_pixels / 1000000):
+        return source_pixels * (1 + blur_copies) * bytes_per_pixel + JOB_MEMORY_OVERHEAD
+    for polaroid_type in job["types"]:
+        canvas_width, canvas_height = get_layout_plan(polaroid_type, photo_size).canvas_size
+        canvas_pixels = max(canvas_pixels, canvas_width * canvas_height)
+    # the largest extra size is alive next to the canvas it is reduced from
+    canvas_pixels += max([parse_output_size(size)["size"] ** 2 for size in job.get("sizes", ())] + [0])
+
+    return (source_pixels * (1 + blur_copies) + canvas_pixels) * bytes_per_pixel + JOB_MEMORY_OVERHEAD
+
+
+def render_chunk(jobs:list) -> list:
+    return [render_job(job) for job in jobs]
+
+
+def get_failed_results(jobs:list, error:Exception) -> list:
+    failed = []
+    for job in jobs:
+        result = {"image": job["image"], "outputs": [], "megapixels": 0.0, "seconds": 0.0, "error": repr(error)}
+        if "id" in job:
+            result["id"] = job["id"]
+        failed.append(result)
+    return failed
+
+
+def iter_batch(jobs, workers:int = None, chunk_size:int = 1, max_in_flight:int = None, memory_budget:int = None):
+    # yields one result per job as soon as its chunk finishes, jobs can be a lazy iterable.
+    # with a memory_budget (bytes) a chunk is only started once its estimated peak fits next to the running ones,
+    # a chunk larger than the whole budget runs on its own.
+    # a worker that dies (e.g. killed for memory) breaks the pool: the chunks running on it fail, the batch goes on in a fresh pool
+    workers = workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * workers * chunk_size
+    max_chunks = max(1, max_in_flight // chunk_size)
+    jobs = iter(jobs)
+
+    exe = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=warm_up)
+    try:
+        pending = dict()
+        reserved = 0
+        waiting = None
+        job_error = None
+        while True:
+            while len(pending) < max_chunks and job_error is None:
+                if waiting is None:
+                    try:
+                        chunk = list(islice(jobs, chunk_size))
+                    except Exception as e:
+                        # the jobs iterable failed (e.g. a broken job file), the running chunks still report before it is raised
+                        job_error = e
+                        break
+                    if not chunk:
+                        break
+                    try:
+                        estimate = max(estimate_peak_memory(job) for job in chunk) if memory_budget else 0
+                    except Exception as e:
+                        # a job whose fields the estimate cannot use (e.g. a mistyped value) fails on its own, the batch goes on
+                        yield from get_failed_results(chunk, e)
+                        continue
+                    waiting = chunk, estimate
+                chunk, estimate = waiting
+                if memory_budget and pending and reserved + estimate > memory_budget:
+                    break
+                try:
+                    future = exe.submit(render_chunk, chunk)
+                except BrokenProcessPool:
+                    # the chunks already on the broken pool fail below, this one waits for the fresh pool
+                    exe.shutdown(wait=False, cancel_futures=True)
+                    exe = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=warm_up)
+                    continue
+                pending[future] = chunk, estimate, exe
+                reserved += estimate
+                waiting = None
+
+            if not pending:
+                if job_error is not None:
+                    raise job_error
+                break
+
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                chunk, estimate, pool = pending.pop(future)
+                reserved -= estimate
+                try:
+                    yield from future.result()
+                except Exception as e:
+                    # the worker itself died, every job of the chunk failed
+                    if isinstance(e, BrokenProcessPool) and pool is exe:
+                        exe.shutdown(wait=False, cancel_futures=True)
+                        exe = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=warm_up)
+                    yield from get_failed_results(chunk, e)
+    finally:
+        exe.shutdown(wait=True, cancel_futures=True)
+
+
+def summarize(results:list, seconds:float) -> dict:
+    megapixels = sum(result["megapixels"] for result in results if not result["error"])
+    images = sum(1 for result in results if not result["error"])
+    return summarize_counts(len(results), images, sum(len(result["outputs"]) for result in results), megapixels, seconds)
+
+
+def summarize_counts(jobs:int, images:int, outputs:int, megapixels:float, seconds:float) -> dict:
+    # for callers that keep running totals instead of every result
+    return {
+        "jobs": jobs,
+        "images": images,
+        "outputs": outputs,
+        "errors": jobs - images,
+        "seconds": seconds,
+        "images_per_second": images / seconds if seconds else 0.0,
+        "megapixels_per_second": megapixels / seconds if seconds else 0.0,
+    }
+
+
+def run_batch(jobs, workers:int = None, chunk_size:int = 1, max_in_flight:int = None, on_result=None, memory_budget:int = None):
+    start = time.perf_counter()
+    results = []
+    for result in iter_batch(jobs, workers, chunk_size, max_in_flight, memory_budget):
+        if on_result:
+            on_result(result)
+        results.append(result)
+    return results, summarize(results, time.perf_counter() - start)
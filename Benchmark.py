@@ -0,0 +1,246 @@
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import PIL
+from PIL import Image, ImageChops, ImageOps, ImageStat
+
+from Instrumentation import CollectingSink, get_rss, set_sink, stage
+from PolaroidBuilder import BLUR_ENGINES, blur_burst_center_image, generate_polaroid
+from PolaroidSettings import ColorMode, PolaroidMode
+
+DEFAULT_SIZES = "1,12,50,200"
+STARTUP_TIMINGS = ["interpreter", "import", "warm_up", "first_render", "import_to_first_image", "process"]
+# the stages generate_polaroid emits, then the encode and the whole render
+STAGES = ["metadata", "decode", "blur", "blur_burst", "exif_transpose", "add_margin", "draw_text", "render", "encode", "generate_polaroid"]
+RSS_SAMPLE_INTERVAL = 0.005
+
+
+class RssSampler:
+    # samples the resident set size on a thread while a stage runs, Pillow allocations are not visible to tracemalloc
+    def __enter__(self):
+        self.peak = get_rss()
+        self.samples = []
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        self.start = time.perf_counter()
+        return self
+
+    def sample(self):
+        while self.running:
+            rss = get_rss()
+            self.peak = max(self.peak, rss)
+            self.samples.append((time.perf_counter(), rss))
+            time.sleep(RSS_SAMPLE_INTERVAL)
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, get_rss())
+
+
+class StageSink(CollectingSink):
+    # stamps every stage event with its end on the perf_counter clock, so the RSS samples taken during it can be found
+    def record(self, event:dict):
+        super().record(dict(event, end=time.perf_counter()))
+
+
+def get_stage_peak(event:dict, samples:list) -> int:
+    # the highest sample inside the stage, or its RSS at entry or exit when it was shorter than the sample interval
+    start = event["end"] - event["seconds"]
+    values = [rss for at, rss in samples if start <= at <= event["end"]]
+    if "rss" in event:
+        values += [event["rss"], event["rss"] - event["rss_delta"]]
+    return max(values) if values else None
+
+
+def generate_test_image(path:str, megapixels:float, portrait:bool):
+    # gradients plus noise so the JPEG and PNG encoders have realistic work, with camera style EXIF
+    long_edge = int((megapixels * 1000000 * 4 / 3) ** 0.5)
+    short_edge = int(long_edge * 3 / 4)
+    size = (short_edge, long_edge) if portrait else (long_edge, short_edge)
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 48)
+    image = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM)))
+
+    exif = Image.Exif()
+    exif[0x010f] = "Samsung"
+    exif[0x0110] = "Galaxy S23 Ultra"
+    exif[0x0132] = "2024:05:01 10:11:12"
+    exif_ifd = exif.get_ifd(0x8769)
+    exif_ifd[0x829a] = 1 / 250
+    exif_ifd[0x8827] = 100
+    exif_ifd[0x920a] = 6.3
+    exif_ifd[0x9205] = 1.7
+    image.save(path, "JPEG", quality=90, exif=exif)
+
+
+def run_case(path:str, megapixels:float, polaroid_type:PolaroidMode, color_mode:ColorMode) -> dict:
+    # the production path end to end, reported per stage it emits with the peak RSS sampled during each.
+    # "generate_polaroid" is the whole render including the decode
+    sink = StageSink(track_memory=True)
+    previous = set_sink(sink)
+    try:
+        with RssSampler() as sampler:
+            with Image.open(path) as im:
+                start = time.perf_counter()
+                polaroid_image = generate_polaroid(im, polaroid_type, color_mode)
+                end = time.perf_counter()
+            with stage("encode"):
+                polaroid_image.save(io.BytesIO(), "PNG", compress_level=1)
+            del polaroid_image
+    finally:
+        set_sink(previous)
+
+    stages = dict()
+    events = [event for event in sink.events if "seconds" in event] + [{"stage": "generate_polaroid", "seconds": end - start, "end": end}]
+    for event in events:
+        # a stage can run more than once per render, its times add up and the highest peak is kept
+        values = stages.setdefault(event["stage"], {"seconds": 0.0, "peak_rss": None})
+        values["seconds"] += event["seconds"]
+        peak = get_stage_peak(event, sampler.samples)
+        if peak is not None and (values["peak_rss"] is None or peak > values["peak_rss"]):
+            values["peak_rss"] = peak
+    for values in stages.values():
+        values["megapixels_per_second"] = megapixels / values["seconds"] if values["seconds"] else None
+    return stages
+
+
+def compare_blur_engines(path:str, engines:list) -> dict:
+    # blur_burst_center_image per engine, timed, with its error against the gaussian engine (the original GaussianBlur output)
+    with Image.open(path) as im:
+        image = ImageOps.exif_transpose(im)
+    reference = None
+    results = dict()
+    for engine in ["gaussian"] + [engine for engine in engines if engine != "gaussian"]:
+        with RssSampler() as sampler:
+            output = blur_burst_center_image(image, engine)
+        if reference is None:
+            reference = output
+        difference = ImageChops.difference(output, reference)
+        extrema = difference.getextrema() if len(difference.getbands()) > 1 else [difference.getextrema()]
+        results[engine] = {"seconds": sampler.seconds, "peak_rss": sampler.peak, "mean_error": sum(ImageStat.Stat(difference).mean) / len(extrema),
+                           "max_error": max(high for _, high in extrema)}
+    return results
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(sizes:list, polaroid_types:list, color_modes:list, workdir:str, repeat:int = 1, blur_engines:list = None) -> dict:
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    blur_results = []
+    for megapixels in sizes:
+        for portrait in (False, True):
+            path = os.path.join(workdir, "bench_{0}MP_{1}.jpg".format(megapixels, "portrait" if portrait else "landscape"))
+            if not os.path.exists(path):
+                generate_test_image(path, megapixels, portrait)
+            if portrait and blur_engines:
+                # the burst background is only drawn for portrait photos
+                engines = compare_blur_engines(path, blur_engines)
+                blur_results.append({"megapixels": megapixels, "engines": engines})
+                for engine, values in engines.items():
+                    print("{0}MP blur {1}: {2:.3f}s, mean error {3:.3f}, max error {4}".format(megapixels, engine, values["seconds"], values["mean_error"], values["max_error"]))
+            for polaroid_type in polaroid_types:
+                for color_mode in color_modes:
+                    for run in range(repeat):
+                        stages = run_case(path, megapixels, polaroid_type, color_mode)
+                        results.append({"megapixels": megapixels, "orientation": "portrait" if portrait else "landscape", "type": polaroid_type.name,
+                                        "color": color_mode.name, "run": run, "stages": stages})
+                        print("{0}MP {1} {2} {3}: {4:.3f}s".format(megapixels, results[-1]["orientation"], polaroid_type.name, color_mode.name, stages["generate_polaroid"]["seconds"]))
+    return {"commit": get_commit(), "python": platform.python_version(), "pillow": PIL.__version__, "machine": platform.machine(), "results": results, "blur_engines": blur_results}
+
+
+def measure_startup(path:str, runs:int = 5, max_output_size:int = None) -> dict:
+    # every run is a fresh ColdStart.py process, without and with POLAROID_WARM_UP. "interpreter" is a bare python
+    # start for reference, "process" the wall time of the whole child as the caller sees it. values are medians
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ColdStart.py")
+    command = [sys.executable, script, path, os.path.join(tempfile.gettempdir(), "polaroid_startup.png")]
+    if max_output_size:
+        command += ["--max-size", str(max_output_size)]
+    interpreter = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        interpreter.append(time.perf_counter() - start)
+
+    results = dict()
+    for name, warm in (("cold", "0"), ("warm_up", "1")):
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            output = subprocess.run(command, capture_output=True, text=True, check=True, env=dict(os.environ, POLAROID_WARM_UP=warm)).stdout
+            timings.append(dict(json.loads(output), process=time.perf_counter() - start, interpreter=statistics.median(interpreter)))
+        results[name] = {key: statistics.median(timing[key] for timing in timings) for key in STARTUP_TIMINGS}
+    return results
+
+
+def summarize_stages(report:dict) -> dict:
+    # total seconds per stage, so two reports over the same cases can be compared
+    totals = dict()
+    for result in report["results"]:
+        for stage, values in result["stages"].items():
+            totals[stage] = totals.get(stage, 0.0) + values["seconds"]
+    return totals
+
+
+def compare(base_path:str, new_path:str):
+    with open(base_path) as fp:
+        base = summarize_stages(json.load(fp))
+    with open(new_path) as fp:
+        new = summarize_stages(json.load(fp))
+    print("{0:<20}{1:>12}{2:>12}{3:>10}".format("stage", "base s", "new s", "speedup"))
+    for stage in STAGES:
+        if stage in base and stage in new:
+            print("{0:<20}{1:>12.3f}{2:>12.3f}{3:>9.2f}x".format(stage, base[stage], new[stage], base[stage] / new[stage] if new[stage] else float("inf")))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per stage benchmark over every PolaroidMode and ColorMode")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma separated megapixels of the synthetic inputs")
+    parser.add_argument("--types", default=",".join(mode.name for mode in PolaroidMode))
+    parser.add_argument("--colors", default=",".join(mode.name for mode in ColorMode))
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--blur-engines", default=",".join(BLUR_ENGINES), help="Engines timed and compared against gaussian, empty to skip")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "polaroid_benchmark"))
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="Compare two result files instead of running")
+    parser.add_argument("--startup", type=int, default=None, metavar="RUNS", help="Time fresh processes from import to the first image instead")
+    parser.add_argument("--startup-size", type=float, default=12, help="Megapixels of the --startup input")
+    parser.add_argument("--startup-max-size", type=int, default=None, help="Render the --startup input at this long edge, like the web previews")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.startup:
+        os.makedirs(args.workdir, exist_ok=True)
+        path = os.path.join(args.workdir, "bench_{0:g}MP_portrait.jpg".format(args.startup_size))
+        if not os.path.exists(path):
+            generate_test_image(path, args.startup_size, True)
+        startup = measure_startup(path, args.startup, args.startup_max_size)
+        print("{0:<24}{1:>10}{2:>10}".format("seconds", *startup))
+        for key in STARTUP_TIMINGS:
+            print("{0:<24}{1:>10.3f}{2:>10.3f}".format(key, *(values[key] for values in startup.values())))
+    else:
+        report = run_benchmark([float(size) if "." in size else int(size) for size in args.sizes.split(",")],
+                               [PolaroidMode[name] for name in args.types.split(",")],
+                               [ColorMode[name] for name in args.colors.split(",")],
+                               args.workdir, args.repeat, [engine for engine in args.blur_engines.split(",") if engine])
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=1)
+        print("Wrote", len(report["results"]), "cases to", args.output)
@@ -0,0 +1,54 @@
+import time
+
+# taken before anything else is imported, so the timings include loading the renderer
+IMPORT_START = time.perf_counter()
+
+import argparse
+import io
+import json
+import os
+
+from PIL import Image
+
+from Encoders import get_encoder
+from PolaroidBuilder import PolaroidSource, render_polaroid, warm_up
+from PolaroidSettings import color_mode_code, polaroid_mode_codes
+
+# Entry point for short lived workers (Lambda style functions, one shot CLI calls). It imports only the render path;
+# with POLAROID_WARM_UP=1 the fonts, image plugins and common layout plans are loaded at import, during the init phase
+IMPORT_SECONDS = time.perf_counter() - IMPORT_START
+WARM_UP_SECONDS = 0.0
+if os.environ.get("POLAROID_WARM_UP") == "1":
+    warm_up()
+    WARM_UP_SECONDS = time.perf_counter() - IMPORT_START - IMPORT_SECONDS
+
+
+def render_bytes(data:bytes, mode:str = "ISC", color:str = "Dark", format:str = "png", max_output_size:int = None, **encoder_settings) -> tuple:
+    # one upload in, (encoded bytes, mime type) out. mode and color are the web codes
+    polaroid_type = polaroid_mode_codes[mode]
+    encoder = get_encoder(format, **encoder_settings)
+    with Image.open(io.BytesIO(data)) as im:
+        source = PolaroidSource(im, max_output_size, [polaroid_type], draft=True)
+    buffer = io.BytesIO()
+    encoder.encode(render_polaroid(source, polaroid_type, color_mode_code[color]), buffer)
+    return buffer.getvalue(), encoder.mime_type
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render one image in a fresh process and report the startup timings as JSON")
+    parser.add_argument("image")
+    parser.add_argument("output")
+    parser.add_argument("--mode", default="ISC", choices=sorted(polaroid_mode_codes))
+    parser.add_argument("--color", default="Dark", choices=sorted(color_mode_code))
+    parser.add_argument("--format", default="png")
+    parser.add_argument("--max-size", type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with open(args.image, "rb") as fp:
+        data, _ = render_bytes(fp.read(), args.mode, args.color, args.format, args.max_size)
+    with open(args.output, "wb") as fp:
+        fp.write(data)
+    render_seconds = time.perf_counter() - start
+    print(json.dumps({"import": IMPORT_SECONDS, "warm_up": WARM_UP_SECONDS, "first_render": render_seconds,
+                      "import_to_first_image": time.perf_counter() - IMPORT_START}))
@@ -0,0 +1,27 @@
+class Encoder:
+    def __init__(self, format:str, extension:str, mime_type:str, modes:tuple, **settings):
+        self.format = format
+        self.extension = extension
+        self.mime_type = mime_type
+        self.modes = modes
+        self.settings = settings
+
+    def encode(self, image, fp):
+        # formats without alpha (JPEG) get the image flattened to the first mode they support
+        if image.mode not in self.modes:
+            image = image.convert(self.modes[0])
+        image.save(fp, self.format, **self.settings)
+
+
+ENCODER_DEFAULTS = {
+    "png": ("PNG", ".png", "image/png", ("RGB", "RGBA", "L", "LA", "P", "I;16"), {"compress_level": 1}),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg", ("RGB", "L", "CMYK"), {"quality": 95, "subsampling": 0}),
+    "webp": ("WEBP", ".webp", "image/webp", ("RGB", "RGBA"), {"quality": 90, "method": 4}),
+}
+
+
+def get_encoder(name:str = "png", **settings) -> Encoder:
+    if name.lower() not in ENCODER_DEFAULTS:
+        raise ValueError("Unknown output format: " + str(name))
+    format, extension, mime_type, modes, defaults = ENCODER_DEFAULTS[name.lower()]
+    return Encoder(format, extension, mime_type, modes, **dict(defaults, **settings))
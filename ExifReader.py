@@ -0,0 +1,106 @@
+import os
+import struct
+from functools import lru_cache
+
+from PIL import Image
+
+from PolaroidBuilder import EXIF_ORIENTATION_TAG, EXIF_ORIENTATION_TRANSPOSE, extract_metadata, transposed_size
+
+EXIF_IFD_TAG = 0x8769
+METADATA_CACHE_SIZE = 4096
+# SOF markers carry the frame size, DHT (C4), JPG (C8) and DAC (CC) share the range but do not
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_SOS_MARKER = 0xDA
+
+
+def read_jpeg_header(path:str):
+    # walks the JPEG segments up to the start of scan, returns (width, height, APP1 EXIF payload) without decoding pixels
+    size, exif = None, None
+    with open(path, "rb") as fp:
+        if fp.read(2) != b"\xff\xd8":
+            return None
+        while True:
+            marker = fp.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                break
+            if marker[1] == 0xFF:
+                # fill byte before the actual marker
+                fp.seek(-1, os.SEEK_CUR)
+                continue
+            if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD7:
+                continue
+            if marker[1] == JPEG_SOS_MARKER:
+                break
+            length = struct.unpack(">H", fp.read(2))[0]
+            payload = fp.read(length - 2)
+            if marker[1] == 0xE1 and exif is None and payload.startswith(b"Exif\x00\x00"):
+                exif = payload
+            elif marker[1] in JPEG_SOF_MARKERS:
+                height, width = struct.unpack(">HH", payload[1:5])
+                size = width, height
+    return size, exif
+
+
+@lru_cache(maxsize=METADATA_CACHE_SIZE)
+def read_header_cached(path:str, file_size:int, mtime_ns:int) -> dict:
+    header = read_jpeg_header(path)
+    if header and header[0]:
+        size, exif_bytes = header
+        exif = Image.Exif()
+        if exif_bytes:
+            exif.load(exif_bytes)
+    else:
+        # not a JPEG, Image.open still only parses the header
+        with Image.open(path) as im:
+            size, exif = im.size, im.getexif()
+
+    exif_data = dict(exif)
+    if EXIF_IFD_TAG in exif:
+        exif_data.update(exif.get_ifd(EXIF_IFD_TAG))
+    photo_size = transposed_size(size, EXIF_ORIENTATION_TRANSPOSE.get(exif.get(EXIF_ORIENTATION_TAG, 1)))
+    return {
+        "image": path,
+        "size": size,
+        "orientation": exif.get(EXIF_ORIENTATION_TAG, 1),
+        "photo_size": photo_size,
+        "is_portrait": photo_size[1] > photo_size[0],
+        "megapixels": size[0] * size[1] / 1000000,
+        "metadata": extract_metadata(exif_data),
+    }
+
+
+def read_header(path:str) -> dict:
+    # memoized per file, a changed file (size or mtime) is read again
+    stat = os.stat(path)
+    return read_header_cached(path, stat.st_size, stat.st_mtime_ns)
+
+
+def build_metadata_index(paths) -> dict:
+    # header of every input up front, unreadable files map to None so the batch can still report them
+    index = dict()
+    for path in paths:
+        try:
+            index[path] = read_header(path)
+        except Exception:
+            index[path] = None
+    return index
+
+
+def build_directory_index(directory:str) -> dict:
+    return build_metadata_index(os.path.join(directory, item) for item in sorted(os.listdir(directory)))
+
+
+JOB_ORDERS = {
+    # largest first packs a process pool better, the long jobs do not end up alone at the tail
+    "largest": lambda header: -header["megapixels"],
+    "smallest": lambda header: header["megapixels"],
+    "orientation": lambda header: (header["is_portrait"], -header["megapixels"]),
+}
+
+
+def order_jobs(jobs:list, index:dict, order:str) -> list:
+    # unreadable inputs go last, they fail fast
+    def key(job):
+        header = index.get(job["image"])
+        return (0, JOB_ORDERS[order](header)) if header else (1, 0)
+    return sorted(jobs, key=key)
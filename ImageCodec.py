@@ -0,0 +1,74 @@
+import argparse
+import base64
+import io
+import time
+
+from PIL import Image
+
+from Encoders import get_encoder
+
+# Conversions between encoded bytes and PIL images for the browser hand-off, plain Python so they can be measured offline.
+# In Pyodide the bytes come from Uint8Array.to_bytes() and go back through Uint8Array.assign() into a Blob object URL
+
+
+def image_from_bytes(data) -> Image.Image:
+    # bytes, bytearray or memoryview, decoding is lazy like Image.open
+    return Image.open(io.BytesIO(data))
+
+
+def image_to_bytes(image:Image.Image, format:str = "png", **settings) -> tuple:
+    # returns (encoded bytes, mime type)
+    encoder = get_encoder(format, **settings)
+    buffer = io.BytesIO()
+    encoder.encode(image, buffer)
+    return buffer.getvalue(), encoder.mime_type
+
+
+def data_url_to_bytes(data_url:str) -> bytes:
+    return base64.b64decode(data_url.split(",", 1)[1])
+
+
+def bytes_to_data_url(data:bytes, mime_type:str) -> str:
+    return "data:" + mime_type + ";base64," + base64.b64encode(data).decode("ascii")
+
+
+def measure_hand_off(path:str, format:str = "png") -> dict:
+    # seconds and traced peak bytes of the codec steps around a render, data URL strings against raw bytes.
+    # the render itself is left out, it is the same on both paths
+    import tracemalloc
+    with open(path, "rb") as fp:
+        upload = fp.read()
+    with Image.open(path) as im:
+        rendered = im.copy()
+
+    def measure(function):
+        tracemalloc.start()
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {"seconds": seconds, "peak_bytes": peak}
+
+    def data_url_path():
+        data_url = bytes_to_data_url(upload, "image/jpeg")
+        image_from_bytes(data_url_to_bytes(data_url)).load()
+        bytes_to_data_url(image_to_bytes(rendered, format)[0], "image/png")
+
+    def bytes_path():
+        image_from_bytes(upload).load()
+        image_to_bytes(rendered, format)
+
+    return {"upload_bytes": len(upload), "data_url": measure(data_url_path), "bytes": measure(bytes_path)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the data URL and raw bytes hand-off for one image")
+    parser.add_argument("image")
+    parser.add_argument("--format", default="png")
+    args = parser.parse_args()
+
+    result = measure_hand_off(args.image, args.format)
+    print("Upload {0:.1f} MB".format(result["upload_bytes"] / 1000000))
+    for name in ("data_url", "bytes"):
+        print("{0:<10}{1:>8.3f}s{2:>10.1f} MB peak in Python".format(name, result[name]["seconds"], result[name]["peak_bytes"] / 1000000))
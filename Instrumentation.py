@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# Installed sink, None disables instrumentation and stage() returns a shared no-op
+_sink = None
+
+
+def get_rss() -> int:
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        # no procfs (macOS), fall back to the process high-water mark. ru_maxrss is in bytes on macOS, KiB elsewhere
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+    except ImportError:
+        # the browser build has neither
+        return 0
+
+
+class NullSink:
+    track_memory = False
+
+    def record(self, event:dict):
+        pass
+
+
+class LoggingSink:
+    def __init__(self, logger:logging.Logger = None, level:int = logging.DEBUG, track_memory:bool = False):
+        self.logger = logger or logging.getLogger("polaroid")
+        self.level = level
+        self.track_memory = track_memory
+
+    def record(self, event:dict):
+        self.logger.log(self.level, "%s", event)
+
+
+class JsonlSink:
+    # one JSON object per line, each written with a single append so several processes can share the file
+    def __init__(self, path:str, track_memory:bool = True):
+        self.path = path
+        self.track_memory = track_memory
+        self.lock = threading.Lock()
+
+    def record(self, event:dict):
+        line = json.dumps(dict(event, pid=os.getpid()), default=str) + "\n"
+        with self.lock, open(self.path, "a") as fp:
+            fp.write(line)
+
+
+class CollectingSink:
+    def __init__(self, track_memory:bool = False):
+        self.track_memory = track_memory
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, event:dict):
+        with self.lock:
+            self.events.append(event)
+
+    def get_stage_timings(self) -> list:
+        return [(event["stage"], event["seconds"]) for event in self.events if "seconds" in event]
+
+
+class Stage:
+    __slots__ = ("sink", "name", "fields", "start", "rss")
+
+    def __init__(self, sink, name:str, fields:dict):
+        self.sink = sink
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.rss = get_rss() if self.sink.track_memory else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        event = {"stage": self.name, "seconds": time.perf_counter() - self.start}
+        if self.rss is not None:
+            rss = get_rss()
+            event["rss"] = rss
+            event["rss_delta"] = rss - self.rss
+        event.update(self.fields)
+        self.sink.record(event)
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NO_STAGE = _NoStage()
+
+
+def set_sink(sink):
+    # returns the previous sink so callers can restore it
+    global _sink
+    previous, _sink = _sink, sink
+    return previous
+
+
+def get_sink():
+    return _sink
+
+
+def stage(name:str, **fields):
+    if _sink is None:
+        return NO_STAGE
+    return Stage(_sink, name, fields)
+
+
+def event(name:str, **fields):
+    if _sink is not None:
+        _sink.record(dict(fields, event=name))
+
+
+def percentile(values:list, fraction:float) -> float:
+    # nearest rank on sorted values
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def aggregate_stage_timings(timings) -> dict:
+    # timings: iterable of (stage, seconds), returns count, total and p50/p90/p99 per stage
+    by_stage = dict()
+    for name, seconds in timings:
+        by_stage.setdefault(name, []).append(seconds)
+    return {name: {"count": len(values), "total": sum(values), "p50": percentile(values, 0.5), "p90": percentile(values, 0.9), "p99": percentile(values, 0.99)}
+            for name, values in by_stage.items()}
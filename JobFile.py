@@ -0,0 +1,129 @@
+import json
+import os
+
+from BatchEngine import parse_output_size
+from Encoders import ENCODER_DEFAULTS, get_encoder
+from PolaroidBuilder import get_blur_engine
+from PolaroidSettings import ColorMode, PolaroidMode, color_mode_code, polaroid_mode_codes
+
+# Result keys written to the log, the stage timings stay out of it
+LOG_KEYS = ("id", "image", "outputs", "megapixels", "seconds", "error", "traceback")
+# Keys a job spec may set, everything else in a job (types, colors, trace, return_encoded, ...) is only set by the runner
+JOB_SPEC_KEYS = ("image", "type", "color", "output", "format", "encoder_settings", "sizes", "max_output_size", "blur_engine", "stream_megapixels")
+OUTPUT_FORMATS = dict({defaults[1]: name for name, defaults in ENCODER_DEFAULTS.items()}, **{".jpeg": "jpeg"})
+
+
+def parse_mode(value:str, modes, codes:dict):
+    # the web codes ("ISC", "Dark") or the enum names ("INSTA_SQUARED_COMPACT", "DARK")
+    if not isinstance(value, str):
+        raise ValueError(modes.__name__ + " must be a string, got " + repr(value))
+    if value in codes:
+        return codes[value]
+    try:
+        return modes[value]
+    except KeyError:
+        raise ValueError("Unknown " + modes.__name__ + ": " + str(value))
+
+
+def parse_job_spec(spec:dict, defaults:dict) -> dict:
+    # {"image", "type", "color", "output"} plus the other JOB_SPEC_KEYS (format, sizes, max_output_size, ...), the rest comes from defaults
+    if not isinstance(spec, dict) or "image" not in spec:
+        raise ValueError("Job spec without image")
+    unknown = sorted(key for key in spec if key not in JOB_SPEC_KEYS)
+    if unknown:
+        raise ValueError("Unknown job spec keys: " + ", ".join(map(str, unknown)))
+    for key in ("image", "output", "format", "blur_engine"):
+        if key in spec and not isinstance(spec[key], str):
+            raise ValueError(key + " must be a string, got " + repr(spec[key]))
+    if "sizes" in spec and not isinstance(spec["sizes"], list):
+        raise ValueError("sizes must be a list, got " + repr(spec["sizes"]))
+    if "encoder_settings" in spec and not isinstance(spec["encoder_settings"], dict):
+        raise ValueError("encoder_settings must be an object, got " + repr(spec["encoder_settings"]))
+    # bool is an int, but true is no size
+    if "max_output_size" in spec and (type(spec["max_output_size"]) is not int or spec["max_output_size"] < 1):
+        raise ValueError("max_output_size must be a positive integer, got " + repr(spec["max_output_size"]))
+    if "stream_megapixels" in spec and (type(spec["stream_megapixels"]) not in (int, float) or spec["stream_megapixels"] < 0):
+        raise ValueError("stream_megapixels must be a non-negative number, got " + repr(spec["stream_megapixels"]))
+    if "format" in spec:
+        get_encoder(spec["format"])
+    if "blur_engine" in spec:
+        get_blur_engine(spec["blur_engine"])
+    job = dict(defaults)
+    job.update((key, value) for key, value in spec.items() if key not in ("type", "color"))
+    if "type" in spec:
+        job["types"] = [parse_mode(spec["type"], PolaroidMode, polaroid_mode_codes)]
+    if "color" in spec:
+        job["colors"] = [parse_mode(spec["color"], ColorMode, color_mode_code)]
+    if "sizes" in spec:
+        job["sizes"] = [parse_output_size(size) for size in spec["sizes"]]
+    if spec.get("output"):
+        if len(job["types"]) * len(job["colors"]) != 1:
+            raise ValueError("output names a single file, the job needs exactly one type and color")
+        if "format" not in spec:
+            job["format"] = OUTPUT_FORMATS.get(os.path.splitext(spec["output"])[1].lower(), job.get("format", "png"))
+    return job
+
+
+def iter_job_specs(path:str, defaults:dict, skip=None, on_invalid=None):
+    # reads the JSONL file one line at a time, so the manifest size does not matter. the line number becomes the job id;
+    # skip(id) drops jobs (already completed), on_invalid(id, error) is told about lines that do not parse
+    with open(path) as fp:
+        for number, line in enumerate(fp, 1):
+            if not line.strip() or (skip and skip(number)):
+                continue
+            try:
+                job = parse_job_spec(json.loads(line), defaults)
+            except (ValueError, TypeError, KeyError) as e:
+                # TypeError and KeyError come from values of the wrong type deeper in, e.g. a size dict without "size"
+                if on_invalid:
+                    on_invalid(number, e)
+                continue
+            job["id"] = number
+            yield job
+
+
+class ResultLog:
+    # append-only JSONL, one entry per finished job written as soon as it is known. reopening it gives the ids that
+    # completed without error, kept as a bitmap so resuming a million line manifest stays small
+    def __init__(self, path:str):
+        self.path = path
+        self.completed = bytearray()
+        self.resumed = 0
+        if os.path.exists(path):
+            with open(path, "rb") as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn last line of an interrupted run
+                        continue
+                    if not entry.get("error") and isinstance(entry.get("id"), int):
+                        self.mark(entry["id"])
+            self.resumed = sum(bin(byte).count("1") for byte in self.completed)
+        self.fp = open(path, "a")
+        if self.fp.tell() and not self.ends_with_newline():
+            self.fp.write("\n")
+
+    def ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as fp:
+            fp.seek(-1, os.SEEK_END)
+            return fp.read(1) == b"\n"
+
+    def mark(self, job_id:int):
+        index, bit = divmod(job_id, 8)
+        if index >= len(self.completed):
+            self.completed.extend(bytes(index + 1 - len(self.completed)))
+        self.completed[index] |= 1 << bit
+
+    def is_completed(self, job_id:int) -> bool:
+        index, bit = divmod(job_id, 8)
+        return index < len(self.completed) and bool(self.completed[index] & (1 << bit))
+
+    def write(self, result:dict):
+        self.fp.write(json.dumps({key: result[key] for key in LOG_KEYS if key in result}) + "\n")
+        self.fp.flush()
+        if not result.get("error") and "id" in result:
+            self.mark(result["id"])
+
+    def close(self):
+        self.fp.close()
@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import time
+
+from Instrumentation import percentile
+
+
+async def read_chunked(reader:asyncio.StreamReader) -> int:
+    received = 0
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if size == 0:
+            await reader.readline()
+            return received
+        await reader.readexactly(size)
+        await reader.readline()
+        received += size
+
+
+async def post_image(host:str, port:int, path:str, data:bytes) -> tuple:
+    # one request per connection, returns (status, response bytes, seconds)
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write("POST {0} HTTP/1.1\r\nHost: {1}\r\nContent-Length: {2}\r\nExpect: 100-continue\r\n\r\n".format(path, host, len(data)).encode())
+        await writer.drain()
+        status_line = await reader.readline()
+        status = int(status_line.split()[1])
+        if status == 100:
+            await reader.readline()
+            writer.write(data)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+        headers = dict()
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding") == "chunked":
+            received = await read_chunked(reader)
+        else:
+            received = len(await reader.readexactly(int(headers.get("content-length", 0))))
+        return status, received, time.perf_counter() - start
+    finally:
+        writer.close()
+
+
+async def run_load(host:str, port:int, path:str, data:bytes, requests:int, concurrency:int) -> list:
+    # concurrency clients send requests back to back until the total is reached
+    remaining = iter(range(requests))
+    results = []
+
+    async def client():
+        for _ in remaining:
+            try:
+                results.append(await post_image(host, port, path, data))
+            except (OSError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+                results.append((repr(e), 0, 0.0))
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test a running Server.py on localhost")
+    parser.add_argument("image")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--mode", default="ISC")
+    parser.add_argument("--color", default="Dark")
+    parser.add_argument("--format", default="png")
+    parser.add_argument("--max-size", type=int, default=None)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as fp:
+        data = fp.read()
+    path = "/render?mode={0}&color={1}&format={2}".format(args.mode, args.color, args.format)
+    if args.max_size:
+        path += "&max_size={0}".format(args.max_size)
+
+    start = time.perf_counter()
+    results = asyncio.run(run_load(args.host, args.port, path, data, args.requests, args.concurrency))
+    seconds = time.perf_counter() - start
+
+    statuses = dict()
+    for status, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print("Statuses", statuses)
+    latencies = [latency for status, _, latency in results if status == 200]
+    if latencies:
+        print("200 latency p50 {0:.3f}s p90 {1:.3f}s p99 {2:.3f}s max {3:.3f}s".format(
+            percentile(latencies, 0.5), percentile(latencies, 0.9), percentile(latencies, 0.99), max(latencies)))
+    print("{0} requests in {1:.2f}s, {2:.2f} rendered/s, {3:.1f} MB received".format(
+        len(results), seconds, len(latencies) / seconds, sum(received for _, received, _ in results) / 1000000))
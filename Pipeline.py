@@ -0,0 +1,190 @@
+import os
+import queue
+import threading
+import time
+import traceback
+
+from PIL import Image
+
+from BatchEngine import encode_outputs, estimate_peak_memory, get_variant_outputs, summarize, use_streaming, write_streamed_variants
+from PolaroidBuilder import PolaroidSource, render_polaroid
+
+# Pillow releases the GIL while decoding, filtering and encoding, so the stages overlap on threads
+STAGE_DONE = object()
+
+
+class MemoryBudget:
+    # bytes the jobs between decode and their last encode may use together, the same rule as iter_batch:
+    # a job waits until its estimate fits next to the running ones, a job larger than the whole budget runs on its own
+    def __init__(self, budget:int):
+        self.budget = budget
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, estimate:int):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.reserved or self.reserved + estimate <= self.budget)
+            self.reserved += estimate
+
+    def release(self, estimate:int):
+        with self.condition:
+            self.reserved -= estimate
+            self.condition.notify_all()
+
+
+class JobState:
+    # tracks one job through the stages, its result is emitted once every rendered variant is encoded
+    def __init__(self, job:dict, budget:MemoryBudget = None):
+        self.job = job
+        self.budget = budget
+        self.estimate = 0
+        self.start = time.perf_counter()
+        self.result = {"image": job["image"], "outputs": [], "megapixels": 0.0, "seconds": 0.0, "error": None}
+        if "id" in job:
+            self.result["id"] = job["id"]
+        self.submitted = 0
+        self.encoded = 0
+        self.rendered = False
+        self.lock = threading.Lock()
+
+    def fail(self, e:Exception):
+        with self.lock:
+            if not self.result["error"]:
+                self.result["error"] = repr(e)
+                self.result["traceback"] = traceback.format_exc()
+
+    def finish(self, results:queue.Queue, rendered:bool = False, encoded:int = 0):
+        with self.lock:
+            self.rendered = self.rendered or rendered
+            self.encoded += encoded
+            if not self.rendered or self.encoded != self.submitted:
+                return
+        self.result["seconds"] = time.perf_counter() - self.start
+        if self.budget:
+            self.budget.release(self.estimate)
+        results.put(self.result)
+
+
+class Stage:
+    # a pool of threads reading from a bounded queue, the last thread to stop passes the end marker on
+    def __init__(self, name:str, workers:int, handler, input_queue:queue.Queue, output_queue:queue.Queue):
+        self.handler = handler
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.running = workers
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.run, name=name + "-" + str(i), daemon=True) for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            item = self.input_queue.get()
+            if item is STAGE_DONE:
+                # let the other threads of this stage see the marker as well
+                self.input_queue.put(STAGE_DONE)
+                break
+            self.handler(item)
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last and self.output_queue is not None:
+            self.output_queue.put(STAGE_DONE)
+
+
+def iter_pipeline(jobs, decode_workers:int = 1, render_workers:int = None, encode_workers:int = 2, queue_size:int = 4, memory_budget:int = None):
+    # decode -> render -> encode with a bounded queue between the stages, yields one result per job as it completes.
+    # with a memory_budget (bytes) a job is only decoded once its estimated peak fits next to the jobs still in the stages.
+    # inputs past the job's streaming threshold are streamed straight to their files on the decode thread
+    budget = MemoryBudget(memory_budget) if memory_budget else None
+    render_workers = render_workers or os.cpu_count()
+    decode_queue = queue.Queue(queue_size)
+    render_queue = queue.Queue(queue_size)
+    encode_queue = queue.Queue(queue_size)
+    results = queue.Queue()
+
+    def decode(state:JobState):
+        try:
+            if budget:
+                state.estimate = estimate_peak_memory(state.job)
+                budget.acquire(state.estimate)
+            with Image.open(state.job["image"]) as im:
+                state.result["megapixels"] = im.width * im.height / 1000000
+                if use_streaming(state.job, state.result["megapixels"]):
+                    # not through render_job, its per job sink would replace the one the other stages report to
+                    state.result["outputs"] = write_streamed_variants(state.job, im)
+                    source = None
+                else:
+                    source = PolaroidSource(im, state.job.get("max_output_size"), state.job["types"], draft=True)
+            if source is None:
+                state.finish(results, rendered=True)
+            else:
+                render_queue.put((state, source))
+        except Exception as e:
+            state.fail(e)
+            state.finish(results, rendered=True)
+
+    def render(item):
+        state, source = item
+        try:
+            for polaroid_type in state.job["types"]:
+                for color_mode in state.job["colors"]:
+                    output_image = render_polaroid(source, polaroid_type, color_mode, state.job.get("blur_engine", "pyramid"))
+                    with state.lock:
+                        state.submitted += 1
+                    encode_queue.put((state, get_variant_outputs(state.job, polaroid_type, color_mode), output_image))
+        except Exception as e:
+            state.fail(e)
+        state.finish(results, rendered=True)
+
+    def encode(item):
+        state, outputs, output_image = item
+        try:
+            written = encode_outputs(outputs, output_image)
+            with state.lock:
+                state.result["outputs"] += written
+        except Exception as e:
+            state.fail(e)
+        state.finish(results, encoded=1)
+
+    stages = [
+        Stage("decode", decode_workers, decode, decode_queue, render_queue),
+        Stage("render", render_workers, render, render_queue, encode_queue),
+        Stage("encode", encode_workers, encode, encode_queue, results),
+    ]
+    for pipeline_stage in stages:
+        pipeline_stage.start()
+
+    job_errors = []
+
+    def feed():
+        # a failing jobs iterable ends the feed, the jobs already in the stages finish and the error is raised after them
+        try:
+            for job in jobs:
+                decode_queue.put(JobState(job, budget))
+        except Exception as e:
+            job_errors.append(e)
+        finally:
+            decode_queue.put(STAGE_DONE)
+
+    threading.Thread(target=feed, name="feed", daemon=True).start()
+
+    while True:
+        result = results.get()
+        if result is STAGE_DONE:
+            break
+        yield result
+    if job_errors:
+        raise job_errors[0]
+
+
+def run_pipeline(jobs, decode_workers:int = 1, render_workers:int = None, encode_workers:int = 2, queue_size:int = 4, on_result=None, memory_budget:int = None):
+    start = time.perf_counter()
+    results = []
+    for result in iter_pipeline(jobs, decode_workers, render_workers, encode_workers, queue_size, memory_budget):
+        if on_result:
+            on_result(result)
+        results.append(result)
+    return results, summarize(results, time.perf_counter() - start)
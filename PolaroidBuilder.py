@@ -1,13 +1,22 @@
+import importlib.util
+import io
+import math
 import os
-import traceback
+import time
+import weakref
+from functools import lru_cache
 
+from Instrumentation import stage, event
 from PolaroidSettings import PolaroidMode, ImageFactor, ColorMode
 from datetime import datetime
-from PIL import ImageOps, ImageDraw, ImageFont, ImageFilter
+from PIL import ImageDraw, ImageFont, ImageFilter
 from PIL import Image
 from PIL.ExifTags import TAGS
 import PIL
 # from memory_profiler import profile
+# asyncio (async API) and numpy (optional, only the box blur engine) are imported where they are used,
+# together they were most of the import time
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None
 PIL.Image.MAX_IMAGE_PIXELS = 933120000
 
 #@profile
@@ -19,20 +28,79 @@ def add_margin(pil_img:Image.Image, top:int, right:int, bottom:int, left:int, co
     result.paste(pil_img, (left, top))
     return result
 
+FONT_CACHE_SIZE = 16
+TEXT_MASK_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=None)
+def load_font_data(font: str) -> bytes:
+    # each font file is read once, every size is then created from memory.
+    # the path is relative to the working directory, or else to this module
+    path = font if os.path.exists(font) else os.path.join(os.path.dirname(os.path.abspath(__file__)), font)
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font: str, font_size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(io.BytesIO(load_font_data(font)), font_size)
+
+
+@lru_cache(maxsize=TEXT_MASK_CACHE_SIZE)
+def measure_text(message: str, font: str, font_size: int, alignment: str = "left") -> tuple:
+    return ImageDraw.Draw(Image.new("L", (1, 1))).textbbox((0, 0), message, font=load_font(font, font_size), align=alignment)
+
+
+@lru_cache(maxsize=TEXT_MASK_CACHE_SIZE)
+def render_text_mask(message: str, font: str, font_size: int, alignment: str = "left", start: tuple = (0.0, 0.0)):
+    # rasterize the text once into an "L" mask, drawing it is then only a colour composite.
+    # start is the sub-pixel part of the position, the glyphs are rendered with the same phase as draw.text would
+    left, top, right, bottom = measure_text(message, font, font_size, alignment)
+    pad_x, pad_y = max(0, -left) + 1, max(0, -top) + 1
+    mask = Image.new("L", (pad_x + right + 2, pad_y + bottom + 2))
+    ImageDraw.Draw(mask).text((pad_x + start[0], pad_y + start[1]), message, font=load_font(font, font_size), fill=255, align=alignment)
+    return mask, (pad_x, pad_y)
+
+
+def text_cache_info() -> dict:
+    return {"font_files": load_font_data.cache_info(), "fonts": load_font.cache_info(), "text_boxes": measure_text.cache_info(), "text_masks": render_text_mask.cache_info()}
+
+
+def clear_text_cache():
+    load_font_data.cache_clear()
+    load_font.cache_clear()
+    measure_text.cache_clear()
+    render_text_mask.cache_clear()
+
+
+def get_text_position(canvas_size: tuple, message: str, width_factor: float, height_factor: float, font: str, font_size: int, alignment: str = "left") -> tuple:
+    W, H = canvas_size
+    _, _, w, h = measure_text(message, font, font_size, alignment)
+    return (W-w)*width_factor, (H-h)*height_factor
+
+
+def paste_text(pil_image: Image.Image, message: str, font_color: tuple, position: tuple, font: str, font_size: int, alignment: str = "left", top: int = 0):
+    # pil_image holds the canvas rows starting at top
+    if message:
+        x, y = position
+        mask, (pad_x, pad_y) = render_text_mask(message, font, font_size, alignment, (math.modf(x)[0], math.modf(y)[0]))
+        ImageDraw.Draw(pil_image).bitmap((int(x) - pad_x, int(y) - pad_y - top), mask, fill=font_color)
+
+
 #@profile
 def draw_text(pil_image: Image.Image, message: str, font_color: tuple, width_factor: float,height_factor: float, font: str, font_size: int, alignment:str = "left") -> Image.Image:
-    W, H = pil_image.size
-    draw = ImageDraw.Draw(pil_image)
-    font = ImageFont.truetype(font, font_size)
-    _, _, w, h = draw.textbbox((0, 0), message, font=font)
-    draw.text(((W-w)*width_factor, (H-h)*height_factor), message, font=font, fill=font_color, align=alignment)
+    position = get_text_position(pil_image.size, message, width_factor, height_factor, font, font_size, alignment)
+    paste_text(pil_image, message, font_color, position, font, font_size, alignment)
     return pil_image
 
-#@profile
-def get_meta_data(im: Image) -> dict:
-    exif_data = im._getexif()
-    metadata_keys = ["Make", "Model", "DateTime", "ImageWidth", "ImageLength", "FocalLength", "MaxApertureValue",
-                     "ISOSpeedRatings", "ExposureTime"]
+
+METADATA_KEYS = ["Make", "Model", "DateTime", "ImageWidth", "ImageLength", "FocalLength", "MaxApertureValue",
+                 "ISOSpeedRatings", "ExposureTime"]
+# metadata of every open image by id, dropped together with the image (images are not hashable)
+_metadata_memo = dict()
+
+
+def extract_metadata(exif_data: dict) -> dict:
     metadata_dict = dict()
     # iterating over all EXIF data fields
     if exif_data:
@@ -40,7 +108,7 @@ def get_meta_data(im: Image) -> dict:
             # get the tag name, instead of human unreadable tag id
             tag = TAGS.get(tag_id, tag_id)
             data = exif_data.get(tag_id)
-            if tag in metadata_keys and str(data) != "nan":
+            if tag in METADATA_KEYS and str(data) != "nan":
                 # decode bytes
                 if isinstance(data, bytes):
                     data = data.decode()
@@ -48,6 +116,14 @@ def get_meta_data(im: Image) -> dict:
 
     return metadata_dict
 
+
+#@profile
+def get_meta_data(im: Image) -> dict:
+    if id(im) not in _metadata_memo:
+        _metadata_memo[id(im)] = extract_metadata(im._getexif())
+        weakref.finalize(im, _metadata_memo.pop, id(im), None)
+    return dict(_metadata_memo[id(im)])
+
 #@profile
 def generate_standard_text_lines(metadata_dict:dict, width:float, height:float):
     main_line = ""
@@ -61,8 +137,6 @@ def generate_standard_text_lines(metadata_dict:dict, width:float, height:float):
         else:
             main_line = metadata_dict.get("DateTime")
 
-    print("Main line :", main_line)
-
     sub_line = "{0:.1f}".format((height * width) / 1000000) + "MP"
     if metadata_dict.get("ImageWidth") and metadata_dict.get("ImageLength"):
         sub_line += "   " + metadata_dict.get("ImageWidth") + "x" + metadata_dict.get("ImageLength")
@@ -81,7 +155,7 @@ def generate_standard_text_lines(metadata_dict:dict, width:float, height:float):
     if metadata_dict.get("ISOSpeedRatings"):
         sub_line += "   ISO" + metadata_dict.get("ISOSpeedRatings")
 
-    print("Sub line :", sub_line)
+    event("text_lines", main_line=main_line, sub_line=sub_line)
 
     return main_line, sub_line
 
@@ -92,8 +166,6 @@ def generate_compacted_text_lines(metadata_dict:dict, width:float, height:float)
     if metadata_dict.get("Make") and metadata_dict.get("Model"):
         main_line = (metadata_dict.get("Make") + " " + metadata_dict.get("Model")).title()
 
-    print("Main line :", main_line)
-
     sub_line = "{0:.1f}".format((height * width) / 1000000) + "MP"
     if metadata_dict.get("ImageWidth") and metadata_dict.get("ImageLength"):
         sub_line += "   " + metadata_dict.get("ImageWidth") + "x" + metadata_dict.get("ImageLength")
@@ -118,52 +190,544 @@ def generate_compacted_text_lines(metadata_dict:dict, width:float, height:float)
     else:
         sub_line += "\n‎ "
 
-    print("Sub line :", sub_line)
+    event("text_lines", main_line=main_line, sub_line=sub_line)
 
     return main_line, sub_line
 
+BLUR_RADIUS = 200
+# The pyramid engine reduces the image until the blur radius is about this many pixels
+PYRAMID_TARGET_RADIUS = 8
+
+
+def gaussian_blur(im:Image.Image, radius:float):
+    # reference engine: full resolution blur, background is sampled at scale 1
+    return im.filter(ImageFilter.GaussianBlur(radius)), 1.0
+
+
+def pyramid_blur(im:Image.Image, radius:float):
+    # a blur this wide has no detail left at full resolution, so reduce first and blur with the equivalent radius
+    factor = max(1, min(int(radius // PYRAMID_TARGET_RADIUS), im.width, im.height))
+    reduced = im.reduce(factor) if factor > 1 else im
+    return reduced.filter(ImageFilter.GaussianBlur(radius / factor)), 1 / factor
+
+
+# Box widths approximating one Gaussian, and the values held per chunk of rows or columns
+BOX_BLUR_PASSES = 3
+BOX_BLUR_CHUNK_VALUES = 256 * 1024
+BOX_BLUR_MODES = ("L", "LA", "RGB", "RGBA")
+
+
+def get_box_sizes(sigma:float, passes:int = BOX_BLUR_PASSES) -> list:
+    # odd box widths whose repeated blur has the variance of a Gaussian with this sigma
+    ideal = math.sqrt(12 * sigma * sigma / passes + 1)
+    lower = int(ideal)
+    if lower % 2 == 0:
+        lower -= 1
+    larger = passes - round((12 * sigma * sigma - passes * lower * lower - 4 * passes * lower - 3 * passes) / (-4 * lower - 4))
+    return [lower] * (passes - larger) + [lower + 2] * larger
+
+
+def box_blur_lines(lines, sizes:list, axis:int):
+    # every box is a difference of two prefix sums along axis, so its cost does not depend on its width.
+    # each pass writes its input into an int32 buffer with the edge pixels extended like Pillow does and a leading zero,
+    # takes one cumulative sum in place and rounds the window sums into the other buffer, which the next pass reads
+    import numpy as np
+    length = lines.shape[axis]
+    margin = max(sizes) // 2 + 1
+
+    def along(start, stop=None):
+        index = [slice(None)] * lines.ndim
+        index[axis] = slice(start, stop)
+        return tuple(index)
+
+    shape = list(lines.shape)
+    shape[axis] = length + 2 * margin
+    buffers = np.empty(shape, np.int32), np.empty(shape, np.int32)
+    current = lines
+    for size in sizes:
+        radius = size // 2
+        padded, target = buffers
+        padded[along(margin - radius - 1, margin - radius)] = 0
+        padded[along(margin - radius, margin)] = current[along(0, 1)]
+        padded[along(margin, margin + length)] = current
+        padded[along(margin + length, margin + length + radius)] = current[along(length - 1, length)]
+        sums = padded[along(margin - radius - 1, margin + length + radius)]
+        np.cumsum(sums, axis=axis, out=sums)
+        current = target[along(margin, margin + length)]
+        np.subtract(sums[along(size)], sums[along(None, -size)], out=current)
+        current += size // 2
+        current //= size
+        buffers = target, padded
+    return current
+
+
+def box_blur_axis(source, target, sizes:list, axis:int):
+    # blurs (height, width, channels) along axis in slabs across the other axis, so the buffers stay within BOX_BLUR_CHUNK_VALUES.
+    # both directions slice the row major array, a transposed view would make every copy a strided gather
+    other = 1 - axis
+    chunk = max(1, BOX_BLUR_CHUNK_VALUES // ((source.shape[axis] + max(sizes)) * source.shape[2]))
+    for start in range(0, source.shape[other], chunk):
+        index = [slice(None)] * 3
+        index[other] = slice(start, start + chunk)
+        index = tuple(index)
+        target[index] = box_blur_lines(source[index], sizes, axis)
+
+
+def box_blur(im:Image.Image, radius:float):
+    # three box blurs through prefix sums (a separable summed-area table), vectorised over the channels.
+    # rows first, then columns, the result between the two is kept as 8 bit
+    if not HAS_NUMPY or im.mode not in BOX_BLUR_MODES:
+        return gaussian_blur(im, radius)
+    import numpy as np
+    sizes = get_box_sizes(radius)
+    array = np.asarray(im)
+    if array.ndim == 2:
+        array = array[:, :, None]
+    horizontal = np.empty_like(array)
+    box_blur_axis(array, horizontal, sizes, 1)
+    output = np.empty_like(array)
+    box_blur_axis(horizontal, output, sizes, 0)
+    return Image.fromarray(output[:, :, 0] if output.shape[2] == 1 else output), 1.0
+
+
+BLUR_ENGINES = {
+    "gaussian": gaussian_blur,
+    "pyramid": pyramid_blur,
+}
+if HAS_NUMPY:
+    BLUR_ENGINES["box"] = box_blur
+
+
+def get_blur_engine(engine:str):
+    if engine not in BLUR_ENGINES:
+        raise ValueError("Unknown blur engine: " + str(engine) + ", available: " + ", ".join(BLUR_ENGINES))
+    return BLUR_ENGINES[engine]
+
+
 #@profile
-def blur_burst_center_image(im:Image.Image) -> Image.Image:
-    blurred_image = im.filter(ImageFilter.GaussianBlur(200))
-    blurred_burst_image = blurred_image.resize((2*im.height, im.height))
-    blurred_burst_cropped_image = blurred_burst_image.crop((im.height*0.4, 0, im.height*1.6, im.height))
+def blur_burst_center_image(im:Image.Image, engine:str = "pyramid") -> Image.Image:
+    blurred_image, scale = get_blur_engine(engine)(im, BLUR_RADIUS)
+    # the blur is stretched to (2*h, h) and cropped to (0.4h, 1.6h), only that crop is upsampled
+    crop_left, crop_right = round(im.height*0.4), round(im.height*1.6)
+    x_ratio = im.width * scale / (2*im.height)
+    blurred_burst_cropped_image = blurred_image.resize((crop_right-crop_left, im.height),
+                                                       box=(crop_left*x_ratio, 0, crop_right*x_ratio, im.height*scale))
     left_start = (blurred_burst_cropped_image.width-im.width)//2
     blurred_burst_cropped_image.paste(im, (left_start, 0))
     return blurred_burst_cropped_image
 
 
-#@profile
-def generate_polaroid(im:Image.Image, polaroid_type:PolaroidMode, color_mode:ColorMode) -> Image.Image:
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+INVERSE_TRANSPOSE = {
+    Image.Transpose.ROTATE_90: Image.Transpose.ROTATE_270,
+    Image.Transpose.ROTATE_270: Image.Transpose.ROTATE_90,
+}
+# Rows of the transposed photo that are written to the canvas at a time
+TRANSPOSE_STRIP_HEIGHT = 512
+
+
+def get_transpose_method(im:Image.Image):
+    # same lookup as ImageOps.exif_transpose, without making the transposed copy
+    return EXIF_ORIENTATION_TRANSPOSE.get(im.getexif().get(EXIF_ORIENTATION_TAG, 1))
+
+
+def transposed_size(size:tuple, method) -> tuple:
+    if method in (Image.Transpose.ROTATE_90, Image.Transpose.ROTATE_270, Image.Transpose.TRANSPOSE, Image.Transpose.TRANSVERSE):
+        return size[1], size[0]
+    return size
+
+
+def transpose_box(box:tuple, method, size:tuple) -> tuple:
+    # maps a box of an image with the given size onto the same pixels after im.transpose(method)
+    W, H = size
+    corners = []
+    for x, y in ((box[0], box[1]), (box[2], box[3])):
+        if method == Image.Transpose.FLIP_LEFT_RIGHT:
+            x, y = W - x, y
+        elif method == Image.Transpose.FLIP_TOP_BOTTOM:
+            x, y = x, H - y
+        elif method == Image.Transpose.ROTATE_180:
+            x, y = W - x, H - y
+        elif method == Image.Transpose.ROTATE_90:
+            x, y = y, W - x
+        elif method == Image.Transpose.ROTATE_270:
+            x, y = H - y, x
+        elif method == Image.Transpose.TRANSPOSE:
+            x, y = y, x
+        elif method == Image.Transpose.TRANSVERSE:
+            x, y = H - y, W - x
+        corners.append((x, y))
+    (x0, y0), (x1, y1) = corners
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
 
-        context_size = max(im.height, im.width)
-        image = ImageOps.exif_transpose(im)
-        print(image.size)
-        is_portrait = image.height > image.width
 
-        if polaroid_type.value.requires_blur_for_portrait and is_portrait:
-            print("Portrait blur image")
-            image = blur_burst_center_image(image)
-
-        image_factor:ImageFactor = polaroid_type.value.landscape_factor if not is_portrait else polaroid_type.value.portrait_factor
-
-
-        polaroid_image = add_margin(image, int(context_size * image_factor.top_factor), int(context_size * image_factor.left_factor),
-                                    int(context_size * image_factor.bottom_factor), int(context_size * image_factor.right_factor), color_mode.value.background_color)
-
-        context_font_size = min(polaroid_image.height, polaroid_image.width)
-
-        main_line, sub_line = generate_compacted_text_lines(get_meta_data(im), im.width, im.height) if polaroid_type.value.is_compacted else generate_standard_text_lines(get_meta_data(im), im.width, im.height)
+#@profile
+def paste_transposed(canvas:Image.Image, im:Image.Image, method, offset:tuple, strip_height:int = TRANSPOSE_STRIP_HEIGHT, top:int = 0):
+    # canvas holds the canvas rows starting at top, only the photo rows inside it are written
+    width, height = transposed_size(im.size, method)
+    first_row, last_row = max(0, top - offset[1]), min(height, top + canvas.height - offset[1])
+    if method is None and first_row == 0 and last_row == height:
+        canvas.paste(im, (offset[0], offset[1] - top))
+        return
+    inverse = INVERSE_TRANSPOSE.get(method, method)
+    for row in range(first_row, last_row, strip_height):
+        bottom = min(row + strip_height, last_row)
+        strip = im.crop(transpose_box((0, row, width, bottom), inverse, (width, height)))
+        canvas.paste(strip.transpose(method) if method is not None else strip, (offset[0], offset[1] + row - top))
+
+
+LAYOUT_PLAN_CACHE_SIZE = 256
+TEXT_FONTS = ("./fonts/SamsungOne-700.ttf", "./fonts/SamsungOne-400.ttf")
+# Upright photo sizes of common phone and camera sensors, warm_up builds their layout plans
+COMMON_PHOTO_SIZES = ((4032, 3024), (3024, 4032), (4000, 3000), (3000, 4000), (4080, 3060), (3060, 4080), (6000, 4000), (4000, 6000))
+WARM_UP_FONT_SIZE = 100
+
+
+class TextSlot:
+    # where one of the two text lines goes, the position still depends on the width of the message
+    __slots__ = ("line", "color", "font", "font_size", "alignment", "width_factor", "height_factor")
+
+    def __init__(self, line:int, color:str, font:str, font_size:int, alignment:str, width_factor:float, height_factor:float):
+        self.line = line
+        self.color = color
+        self.font = font
+        self.font_size = font_size
+        self.alignment = alignment
+        self.width_factor = width_factor
+        self.height_factor = height_factor
+
+
+class LayoutPlan:
+    # every pixel offset and font size of one PolaroidMode at one photo size, the factors are only read here
+    __slots__ = ("polaroid_type", "photo_size", "is_portrait", "burst_background", "is_compacted", "canvas_size", "inner_box", "photo_offset", "texts")
+
+    def __init__(self, polaroid_type:PolaroidMode, photo_size:tuple):
+        self.polaroid_type = polaroid_type
+        self.photo_size = photo_size
+        self.is_portrait = photo_size[1] > photo_size[0]
+        self.burst_background = polaroid_type.value.requires_blur_for_portrait and self.is_portrait
+        self.is_compacted = polaroid_type.value.is_compacted
+        image_factor:ImageFactor = polaroid_type.value.portrait_factor if self.is_portrait else polaroid_type.value.landscape_factor
+
+        photo_width, photo_height = photo_size
+        context_size = max(photo_size)
+        inner_width = round(photo_height*1.6) - round(photo_height*0.4) if self.burst_background else photo_width
+        # add_margin is called as (top, left_factor, bottom, right_factor), so the right factor sets the left margin
+        top = int(context_size * image_factor.top_factor)
+        right = int(context_size * image_factor.left_factor)
+        bottom = int(context_size * image_factor.bottom_factor)
+        left = int(context_size * image_factor.right_factor)
+        self.canvas_size = (inner_width + left + right, photo_height + top + bottom)
+        self.inner_box = (left, top, left + inner_width, top + photo_height)
+        self.photo_offset = (left + (inner_width - photo_width)//2, top)
+
+        context_font_size = min(self.canvas_size)
+        self.texts = (
+            TextSlot(0, "main_color", TEXT_FONTS[0], int(context_font_size / image_factor.main_text_font_factor), image_factor.main_text_alignment,
+                     image_factor.main_text_start_factor, image_factor.main_text_height_factor),
+            TextSlot(1, "sub_color", TEXT_FONTS[1], int(context_font_size / image_factor.sub_text_font_factor), image_factor.sub_text_alignment,
+                     image_factor.sub_text_start_factor, image_factor.sub_text_height_factor),
+        )
+
+    def place_texts(self, text_lines:tuple) -> list:
+        # (slot, message, position) per text line, measuring goes through the measure_text cache
+        placed = []
+        for slot in self.texts:
+            message = text_lines[slot.line].strip()
+            placed.append((slot, message, get_text_position(self.canvas_size, message, slot.width_factor, slot.height_factor, slot.font, slot.font_size, slot.alignment)))
+        return placed
+
+
+@lru_cache(maxsize=LAYOUT_PLAN_CACHE_SIZE)
+def get_layout_plan(polaroid_type:PolaroidMode, photo_size:tuple) -> LayoutPlan:
+    # photo_size is the upright size, so it carries the orientation. a batch from one camera reuses a handful of plans
+    return LayoutPlan(polaroid_type, photo_size)
+
+
+def warm_up(polaroid_types:list = None, photo_sizes:tuple = COMMON_PHOTO_SIZES):
+    # for short lived workers and the browser page: loads what the first render would otherwise load on the way (image
+    # plugins, EXIF and date parsing, font files) and builds the layout plans of the usual photo sizes, so the first
+    # render only pays for its own pixels. polaroid_types None is every mode, photo_sizes () skips the plans
+    Image.preinit()
+    from PIL import TiffImagePlugin
+    datetime.strptime("2000:01:01 00:00:00", "%Y:%m:%d %H:%M:%S")
+    for font in TEXT_FONTS:
+        measure_text("0", font, WARM_UP_FONT_SIZE)
+    for polaroid_type in polaroid_types or list(PolaroidMode):
+        for photo_size in photo_sizes:
+            get_layout_plan(polaroid_type, photo_size)
 
-        polaroid_image = draw_text(polaroid_image, main_line.strip(), color_mode.value.main_color, image_factor.main_text_start_factor, image_factor.main_text_height_factor,
-                                   "./fonts/SamsungOne-700.ttf", int(context_font_size / image_factor.main_text_font_factor), image_factor.main_text_alignment)
 
-        polaroid_image = draw_text(polaroid_image, sub_line.strip(), color_mode.value.sub_color, image_factor.sub_text_start_factor, image_factor.sub_text_height_factor,
-                                   "./fonts/SamsungOne-400.ttf", int(context_font_size / image_factor.sub_text_font_factor), image_factor.sub_text_alignment)
+#@profile
+def paste_burst_background(canvas:Image.Image, blurred:Image.Image, scale:float, plan:LayoutPlan, top:int = 0):
+    photo_width, photo_height = plan.photo_size
+    inner_left, inner_top, inner_right, inner_bottom = plan.inner_box
+    photo_left = plan.photo_offset[0]
+    first_row, last_row = max(0, top - inner_top), min(photo_height, top + canvas.height - inner_top)
+    if last_row <= first_row:
+        return
+    # same mapping as blur_burst_center_image, but only the strips beside the photo are upsampled
+    crop_left = round(photo_height*0.4)
+    x_ratio = photo_width * scale / (2*photo_height)
+    for strip_left, strip_right in ((inner_left, photo_left), (photo_left + photo_width, inner_right)):
+        if strip_right <= strip_left:
+            continue
+        source_left = (crop_left + strip_left - inner_left) * x_ratio
+        source_right = (crop_left + strip_right - inner_left) * x_ratio
+        strip = blurred.resize((strip_right - strip_left, last_row - first_row), box=(source_left, first_row*scale, source_right, last_row*scale))
+        canvas.paste(strip, (strip_left, inner_top + first_row - top))
+
+
+def get_canvas_long_edge(photo_size:tuple, polaroid_types:list) -> int:
+    return max(max(get_layout_plan(polaroid_type, photo_size).canvas_size) for polaroid_type in polaroid_types)
+
+
+def get_render_size(size:tuple, method, polaroid_types:list, max_output_size:int) -> tuple:
+    # largest source size whose polaroids (for every requested mode) fit within max_output_size
+    scale = min(1.0, max_output_size / get_canvas_long_edge(transposed_size(size, method), polaroid_types))
+    while True:
+        render_size = max(1, int(size[0] * scale)), max(1, int(size[1] * scale))
+        long_edge = get_canvas_long_edge(transposed_size(render_size, method), polaroid_types)
+        if long_edge <= max_output_size or render_size == (1, 1):
+            return render_size
+        scale *= max_output_size / (long_edge + 1)
+
+
+class PolaroidSource:
+    # everything about the input that does not depend on PolaroidMode or ColorMode, computed once per image.
+    # with max_output_size the image is rendered at the size the output needs. draft is for images the caller opened
+    # just for this source: a JPEG is then decoded at reduced scale, which changes im in place. otherwise a copy is resized
+    def __init__(self, im:Image.Image, max_output_size:int = None, polaroid_types:list = None, draft:bool = False):
+        self.original_size = im.size
+        with stage("metadata"):
+            self.transpose_method = get_transpose_method(im)
+            self.metadata = get_meta_data(im)
+        self.is_portrait = transposed_size(im.size, self.transpose_method)[1] > transposed_size(im.size, self.transpose_method)[0]
+
+        with stage("decode", size=im.size):
+            if max_output_size:
+                render_size = get_render_size(im.size, self.transpose_method, polaroid_types or list(PolaroidMode), max_output_size)
+                if render_size != im.size:
+                    if draft:
+                        # draft decodes a JPEG at the smallest 1/2, 1/4 or 1/8 scale that is large enough, it does nothing once loaded
+                        im.draft(im.mode, render_size)
+                        im.load()
+                    if im.size != render_size:
+                        im = im.resize(render_size, reducing_gap=3.0)
+            im.load()
+
+        self.image = im
+        self.scale = im.width / self.original_size[0]
+        self.context_size = max(im.height, im.width)
+        self.photo_size = transposed_size(im.size, self.transpose_method)
+        self._text_lines = dict()
+        self._blurred = dict()
+
+    def get_text_lines(self, is_compacted:bool):
+        if is_compacted not in self._text_lines:
+            text_lines = generate_compacted_text_lines if is_compacted else generate_standard_text_lines
+            self._text_lines[is_compacted] = text_lines(self.metadata, self.original_size[0], self.original_size[1])
+        return self._text_lines[is_compacted]
+
+    def get_blurred(self, blur_engine:str):
+        if blur_engine not in self._blurred:
+            with stage("blur", engine=blur_engine):
+                # the radius is relative to the full size image, so a downscaled render looks the same
+                blurred, scale = get_blur_engine(blur_engine)(self.image, BLUR_RADIUS * self.scale)
+                if self.transpose_method is not None:
+                    blurred = blurred.transpose(self.transpose_method)
+            self._blurred[blur_engine] = blurred, scale
+        return self._blurred[blur_engine]
+
+
+def get_layout(source:PolaroidSource, polaroid_type:PolaroidMode) -> LayoutPlan:
+    # the same for every ColorMode
+    return get_layout_plan(polaroid_type, source.photo_size)
 
 
-        return polaroid_image
+#@profile
+def iter_compose_rows(target:Image.Image, top:int, source:PolaroidSource, plan:LayoutPlan, color_mode:ColorMode, blur_engine:str = "pyramid"):
+    # writes canvas rows [top, top + target.height) into target, which is already filled with the background colour.
+    # yields the name of each finished stage so a caller can hand control back to an event loop in between
+    if plan.burst_background:
+        blurred, scale = source.get_blurred(blur_engine)
+        yield "blur"
+        with stage("blur_burst"):
+            paste_burst_background(target, blurred, scale, plan, top)
+        yield "blur_burst"
+
+    with stage("exif_transpose"):
+        paste_transposed(target, source.image, source.transpose_method, plan.photo_offset, top=top)
+    yield "exif_transpose"
+
+    with stage("draw_text"):
+        for slot, message, position in plan.place_texts(source.get_text_lines(plan.is_compacted)):
+            paste_text(target, message, getattr(color_mode.value, slot.color), position, slot.font, slot.font_size, slot.alignment, top)
+    yield "draw_text"
+
+
+def compose_rows(target:Image.Image, top:int, source:PolaroidSource, plan:LayoutPlan, color_mode:ColorMode, blur_engine:str = "pyramid"):
+    for _ in iter_compose_rows(target, top, source, plan, color_mode, blur_engine):
+        pass
+
+
+def iter_render_steps(source:PolaroidSource, polaroid_type:PolaroidMode, color_mode:ColorMode, blur_engine:str = "pyramid"):
+    # render_polaroid as a generator, yields after every stage and returns the finished image
+    with stage("render", type=polaroid_type.name, color=color_mode.name):
+        plan = get_layout(source, polaroid_type)
+        # the output is allocated once, background, photo and text are written straight into it
+        with stage("add_margin", size=plan.canvas_size):
+            polaroid_image = Image.new(source.image.mode, plan.canvas_size, color_mode.value.background_color)
+        yield "add_margin"
+        yield from iter_compose_rows(polaroid_image, 0, source, plan, color_mode, blur_engine)
+    return polaroid_image
 
 
-def generate_polaroid_from_url(image_url:str, polaroid_type:PolaroidMode, color_mode:ColorMode) -> Image.Image:
-    with Image.open(image_url) as im:
-        return generate_polaroid(im, polaroid_type, color_mode)
\ No newline at end of file
+#@profile
+def render_polaroid(source:PolaroidSource, polaroid_type:PolaroidMode, color_mode:ColorMode, blur_engine:str = "pyramid") -> Image.Image:
+    steps = iter_render_steps(source, polaroid_type, color_mode, blur_engine)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+
+async def render_polaroid_async(source:PolaroidSource, polaroid_type:PolaroidMode, color_mode:ColorMode, blur_engine:str = "pyramid") -> Image.Image:
+    # same render on the running loop, other tasks (and the browser, under Pyodide) get a turn between the stages
+    import asyncio
+    steps = iter_render_steps(source, polaroid_type, color_mode, blur_engine)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+        await asyncio.sleep(0)
+
+
+def open_polaroid_source(item, polaroid_types:list, max_output_size:int = None) -> PolaroidSource:
+    # item is a PIL image, encoded bytes, a path or a file object
+    if isinstance(item, Image.Image):
+        return PolaroidSource(item, max_output_size, polaroid_types)
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        item = io.BytesIO(item)
+    with Image.open(item) as im:
+        return PolaroidSource(im, max_output_size, polaroid_types, draft=True)
+
+
+def render_batch_item(index:int, item, polaroid_type:PolaroidMode, color_mode:ColorMode, blur_engine:str = "pyramid", max_output_size:int = None) -> dict:
+    start = time.perf_counter()
+    try:
+        source = open_polaroid_source(item, [polaroid_type], max_output_size)
+        return {"index": index, "image": render_polaroid(source, polaroid_type, color_mode, blur_engine), "error": None, "seconds": time.perf_counter() - start}
+    except Exception as e:
+        return {"index": index, "image": None, "error": repr(e), "seconds": time.perf_counter() - start}
+
+
+async def aenumerate(items):
+    index = 0
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield index, item
+            index += 1
+    else:
+        for item in items:
+            yield index, item
+            index += 1
+
+
+async def render_batch(images, polaroid_type:PolaroidMode, color_mode:ColorMode, blur_engine:str = "pyramid", max_output_size:int = None, executor=None):
+    # async generator of {"index", "image", "error", "seconds"}, one per input as soon as it is rendered.
+    # without an executor the images are rendered in order on the running loop, yielding to it between stages;
+    # with a thread or process pool they run in parallel and come back in completion order.
+    # images may be an async iterable, so uploads can be read one at a time as the batch reaches them
+    import asyncio
+    if executor is not None:
+        loop = asyncio.get_running_loop()
+        futures = [loop.run_in_executor(executor, render_batch_item, index, item, polaroid_type, color_mode, blur_engine, max_output_size)
+                   async for index, item in aenumerate(images)]
+        for future in asyncio.as_completed(futures):
+            yield await future
+        return
+
+    async for index, item in aenumerate(images):
+        # lets the caller's progress update show before the decode starts
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+        try:
+            source = open_polaroid_source(item, [polaroid_type], max_output_size)
+            await asyncio.sleep(0)
+            output_image = await render_polaroid_async(source, polaroid_type, color_mode, blur_engine)
+            result = {"index": index, "image": output_image, "error": None, "seconds": time.perf_counter() - start}
+        except Exception as e:
+            result = {"index": index, "image": None, "error": repr(e), "seconds": time.perf_counter() - start}
+        yield result
+
+
+def generate_polaroid(im:Image.Image, polaroid_type:PolaroidMode, color_mode:ColorMode, blur_engine:str = "pyramid", max_output_size:int = None) -> Image.Image:
+    return render_polaroid(PolaroidSource(im, max_output_size, [polaroid_type]), polaroid_type, color_mode, blur_engine)
+
+
+def reduce_to_long_edge(im:Image.Image, long_edge:int) -> Image.Image:
+    # the integer part of the scale is a box reduce, only what is left below 2x goes through a resampling filter
+    if max(im.size) <= long_edge:
+        return im
+    scale = long_edge / max(im.size)
+    size = max(1, round(im.width * scale)), max(1, round(im.height * scale))
+    factor = int(1 / scale)
+    if factor > 1:
+        im = im.reduce(factor)
+    if im.size != size:
+        im = im.resize(size, Image.LANCZOS)
+    return im
+
+
+def iter_output_sizes(im:Image.Image, long_edges:list):
+    # yields (long_edge, image) largest first, None stands for the render itself. every size is reduced from the previous one
+    for long_edge in sorted(long_edges, key=lambda edge: math.inf if edge is None else edge, reverse=True):
+        if long_edge is not None:
+            with stage("reduce", long_edge=long_edge):
+                im = reduce_to_long_edge(im, long_edge)
+        yield long_edge, im
+
+
+def generate_polaroid_sizes(im:Image.Image, polaroid_type:PolaroidMode, color_mode:ColorMode, long_edges:list, blur_engine:str = "pyramid", max_output_size:int = None) -> dict:
+    # one render, {long_edge: image} for every requested size
+    return dict(iter_output_sizes(generate_polaroid(im, polaroid_type, color_mode, blur_engine, max_output_size), long_edges))
+
+
+def iter_polaroid_variants(im:Image.Image, polaroid_types:list, color_modes:list, blur_engine:str = "pyramid", max_output_size:int = None, draft:bool = False):
+    # the decode, EXIF, text lines and the burst blur are shared by every variant, outputs are yielded one at a time.
+    # draft as for PolaroidSource, only when im was opened for this call
+    source = PolaroidSource(im, max_output_size, polaroid_types, draft)
+    for polaroid_type in polaroid_types:
+        for color_mode in color_modes:
+            yield (polaroid_type, color_mode), render_polaroid(source, polaroid_type, color_mode, blur_engine)
+
+
+def generate_polaroid_variants(im:Image.Image, polaroid_types:list, color_modes:list, blur_engine:str = "pyramid", max_output_size:int = None) -> dict:
+    return dict(iter_polaroid_variants(im, polaroid_types, color_modes, blur_engine, max_output_size))
+
+
+def open_url(image_url:str, storage=None) -> Image.Image:
+    # a path or file object, or with a storage backend (see Storage.py) a key in it
+    return Image.open(io.BytesIO(storage.read(image_url)) if storage is not None else image_url)
+
+
+def generate_polaroid_from_url(image_url:str, polaroid_type:PolaroidMode, color_mode:ColorMode, blur_engine:str = "pyramid", max_output_size:int = None, storage=None) -> Image.Image:
+    with open_url(image_url, storage) as im:
+        return render_polaroid(PolaroidSource(im, max_output_size, [polaroid_type], draft=True), polaroid_type, color_mode, blur_engine)
+
+
+def generate_polaroid_variants_from_url(image_url:str, polaroid_types:list, color_modes:list, blur_engine:str = "pyramid", max_output_size:int = None, storage=None) -> dict:
+    with open_url(image_url, storage) as im:
+        return dict(iter_polaroid_variants(im, polaroid_types, color_modes, blur_engine, max_output_size, draft=True))
@@ -1,5 +1,8 @@
 from enum import Enum
 
+# Bump when the rendering changes in a way the factors below do not capture
+SETTINGS_VERSION = 1
+
 
 class ImageFactor:
     def __init__(self, left, right, top, bottom, main_text_height, main_text_start, sub_text_height, sub_text_start, main_text_rotation, main_text_font_factor, sub_text_font_factor, main_text_alignment, sub_text_alignment):
@@ -29,6 +32,10 @@ class ImageSettings:
         self.is_compacted = is_compacted
 
 class PolaroidMode(Enum):
+   # the values are plain objects, so pickle by name to hand modes to worker processes
+   def __reduce_ex__(self, protocol):
+       return getattr, (self.__class__, self.name)
+
    FULL_POLAROID = ImageSettings(
        portrait_factor=ImageFactor(0.02,0.02,0.02,0.13,0.93, 0.5, 0.96,0.5, 0,30.44,42.14, "left", "left"),
        landscape_factor=ImageFactor(0.02,0.02,0.02,0.125,0.93, 0.5, 0.97,0.5, 0,31.44,44.14, "left", "left")
@@ -76,5 +83,37 @@ class ColorSchema:
         self.background_color = background_color
 
 class ColorMode(Enum):
+    def __reduce_ex__(self, protocol):
+        return getattr, (self.__class__, self.name)
+
     LIGHT = ColorSchema((0, 0, 0), (128, 128, 128), (255, 255, 255))
-    DARK = ColorSchema((255, 255, 255), (128, 128, 128),(0, 0, 0))
\ No newline at end of file
+    DARK = ColorSchema((255, 255, 255), (128, 128, 128),(0, 0, 0))
+
+
+# Short codes used by the web form and the render service
+polaroid_mode_codes = {
+    "F": PolaroidMode.FULL_POLAROID,
+    "H": PolaroidMode.HALF_POLAROID,
+    "Q": PolaroidMode.QUARTER_POLAROID,
+    "IS": PolaroidMode.INSTA_SQUARED,
+    "FC": PolaroidMode.FULL_POLAROID_COMPACT,
+    "HC": PolaroidMode.HALF_POLAROID_COMPACT,
+    "QC": PolaroidMode.QUARTER_POLAROID_COMPACT,
+    "ISC": PolaroidMode.INSTA_SQUARED_COMPACT,
+}
+
+color_mode_code = {
+    "Dark": ColorMode.DARK,
+    "Light": ColorMode.LIGHT
+}
+
+
+def get_settings_fingerprint() -> str:
+    # changes whenever any ImageFactor, ImageSettings or ColorSchema value is edited
+    # hashlib is only needed by the render cache, it stays out of the import
+    import hashlib
+    values = [SETTINGS_VERSION]
+    for mode in list(PolaroidMode) + list(ColorMode):
+        settings = vars(mode.value)
+        values.append((mode.name, sorted((key, vars(value) if hasattr(value, "__dict__") else value) for key, value in settings.items())))
+    return hashlib.sha256(repr(values).encode()).hexdigest()
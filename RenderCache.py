@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import time
+
+from BatchEngine import get_variant_outputs, parse_output_size
+from PolaroidBuilder import TEXT_FONTS, load_font_data
+from PolaroidSettings import SETTINGS_VERSION, get_settings_fingerprint
+
+CACHE_MANIFEST_NAME = ".polaroid_cache.json"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(path:str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class RenderCache:
+    # manifest of rendered outputs keyed by a hash of everything that affects them.
+    # sources are only re-hashed when their size or mtime changed, so a rerun costs one stat per file
+    def __init__(self, output_dir:str, invalidate_on_settings_change:bool = True, manifest_name:str = CACHE_MANIFEST_NAME):
+        self.path = os.path.join(output_dir, manifest_name)
+        self.manifest = {"settings": None, "sources": {}, "entries": {}}
+        if os.path.exists(self.path):
+            with open(self.path) as fp:
+                self.manifest = json.load(fp)
+        # the same font bytes the renderer loads, found from any working directory
+        self.fonts = "".join(hashlib.sha256(load_font_data(font)).hexdigest() for font in TEXT_FONTS)
+
+        fingerprint = get_settings_fingerprint()
+        if invalidate_on_settings_change and self.manifest["settings"] not in (None, fingerprint):
+            self.invalidate()
+        self.manifest["settings"] = fingerprint
+        self.hits = 0
+        self.misses = 0
+
+    def get_source_hash(self, image:str) -> str:
+        stat = os.stat(image)
+        known = self.manifest["sources"].get(image)
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return known["sha256"]
+        source_hash = hash_file(image)
+        self.manifest["sources"][image] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": source_hash}
+        return source_hash
+
+    def get_key(self, job:dict, polaroid_type, color_mode) -> str:
+        values = [self.get_source_hash(job["image"]), polaroid_type.name, color_mode.name, self.fonts, SETTINGS_VERSION,
+                  job.get("format", "png"), sorted(job.get("encoder_settings", {}).items()), job.get("max_output_size"),
+                  job.get("blur_engine", "pyramid"), [sorted(parse_output_size(size).items()) for size in job.get("sizes", ())]]
+        return hashlib.sha256(repr(values).encode()).hexdigest()
+
+    def is_fresh(self, job:dict) -> bool:
+        # a job is skipped only when every one of its variants is cached and its output is still on disk
+        try:
+            for polaroid_type in job["types"]:
+                for color_mode in job["colors"]:
+                    entry = self.manifest["entries"].get(self.get_key(job, polaroid_type, color_mode))
+                    if not entry or not all(os.path.exists(output) for output in [entry["output"]] + entry.get("sized", [])):
+                        self.misses += 1
+                        return False
+        except OSError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def record(self, job:dict, result:dict):
+        if result["error"]:
+            return
+        now = time.time()
+        for polaroid_type in job["types"]:
+            for color_mode in job["colors"]:
+                outputs = [output for _, _, output in get_variant_outputs(job, polaroid_type, color_mode)]
+                if not all(output in result["outputs"] for output in outputs):
+                    continue
+                self.manifest["entries"][self.get_key(job, polaroid_type, color_mode)] = {
+                    "output": outputs[0], "sized": outputs[1:], "bytes": sum(os.path.getsize(output) for output in outputs), "created": now}
+
+    def invalidate(self):
+        self.manifest["entries"] = {}
+
+    def evict(self, max_bytes:int = None, max_age:float = None, delete_outputs:bool = True) -> int:
+        # drops entries older than max_age seconds, then the oldest ones until the total is within max_bytes
+        entries = sorted(self.manifest["entries"].items(), key=lambda item: item[1]["created"])
+        evicted = []
+        if max_age is not None:
+            now = time.time()
+            evicted += [item for item in entries if now - item[1]["created"] > max_age]
+            entries = [item for item in entries if now - item[1]["created"] <= max_age]
+        if max_bytes is not None:
+            total = sum(entry["bytes"] for _, entry in entries)
+            while entries and total > max_bytes:
+                total -= entries[0][1]["bytes"]
+                evicted.append(entries.pop(0))
+        for key, entry in evicted:
+            del self.manifest["entries"][key]
+            if delete_outputs:
+                for output in [entry["output"]] + entry.get("sized", []):
+                    if os.path.exists(output):
+                        os.remove(output)
+        return len(evicted)
+
+    def save(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as fp:
+            json.dump(self.manifest, fp)
+        os.replace(temporary_path, self.path)
@@ -1,43 +1,261 @@
-import concurrent.futures
+import argparse
+import itertools
 import os
-import traceback
-import uuid
+import time
 
-from PolaroidBuilder import generate_polaroid_from_url
+from BatchEngine import iter_batch, run_batch, summarize_counts, parse_output_size
+from Encoders import ENCODER_DEFAULTS
+from Instrumentation import CollectingSink, JsonlSink, aggregate_stage_timings, percentile, set_sink
+from ExifReader import JOB_ORDERS, build_metadata_index, order_jobs
+from JobFile import ResultLog, iter_job_specs
+from Pipeline import iter_pipeline, run_pipeline
+from RenderCache import RenderCache
+from PolaroidBuilder import BLUR_ENGINES
 from PolaroidSettings import ColorMode, PolaroidMode
+from Storage import is_storage_url, iter_storage_batch, open_storage
+from Watcher import iter_watch
 
 # import resource
 # resource.setrlimit(resource.RLIMIT_AS, (1000000000,1000000000))
 
-error_items = list()
 
+def print_result(result):
+    if result["error"]:
+        print(result.get("traceback", ""))
+        print("Exception", result["image"], result["error"])
+    else:
+        print("Done", result["image"], "{0:.2f}s".format(result["seconds"]))
 
-def main(data):
+
+def print_watch_result(result):
+    print_result(result)
+    print("  latency {0:.2f}s, queue depth {1}".format(result["latency"], result["queue_depth"]))
+
+
+def print_summary(summary:dict):
+    print("Processed {images} images ({outputs} outputs) in {seconds:.2f}s, {images_per_second:.2f} images/s, {megapixels_per_second:.2f} MP/s".format(**summary))
+
+
+def build_job(image:str, args) -> dict:
+    job = {"image": image, "colors": list(ColorMode), "types": [PolaroidMode.INSTA_SQUARED_COMPACT], "output_dir": args.output, "format": args.format, "blur_engine": args.blur_engine}
+    if args.quality is not None:
+        job["encoder_settings"] = {"quality": args.quality}
+    if args.stage_stats:
+        job["instrument"] = True
+    if args.trace:
+        job["trace"] = args.trace
+    if args.max_output_size:
+        job["max_output_size"] = args.max_output_size
+    if args.stream_above is not None:
+        job["stream_megapixels"] = args.stream_above
+    if args.sizes:
+        job["sizes"] = args.sizes
+    return job
+
+
+def run_job_file(args):
+    # the JSONL job file is read lazily and every result is appended to the log as it finishes, a rerun skips what the log has as done
+    log = ResultLog(args.result_log or args.jobs + ".results.jsonl")
+    if log.resumed:
+        print("Resuming,", log.resumed, "jobs already completed")
+
+    invalid = []
+
+    def on_invalid(job_id, error):
+        invalid.append(job_id)
+        log.write({"id": job_id, "image": None, "outputs": [], "error": "Invalid job spec: " + str(error)})
+        print("Invalid job spec on line", job_id, error)
+
+    defaults = build_job(None, args)
+    del defaults["image"]
+    jobs = iter_job_specs(args.jobs, defaults, log.is_completed, on_invalid)
+    if args.pipeline:
+        results = iter_pipeline(jobs, args.decode_workers, args.render_workers, args.encode_workers, args.queue_size)
+    else:
+        results = iter_batch(jobs, args.workers, args.chunk_size, args.max_in_flight, args.memory_budget * 1024 * 1024 if args.memory_budget else None)
+
+    start = time.perf_counter()
+    count, images, outputs, megapixels = 0, 0, 0, 0.0
     try:
-        output_file_name = data["image"].split("/")[-1].replace(".jpg", "") + "_" + str(data["type"]).split(".")[-1] + "_" + str(data["color"]).split(".")[-1] + ".png"
-        output_image = generate_polaroid_from_url(data["image"], data["type"], data["color"])
-        output_image.save("./output/" + output_file_name,"PNG",compress_level=1)
-    except Exception as e:
-        traceback.print_exc()
-        print("Exception", str(e))
-        error_items.append(data)
+        for result in results:
+            log.write(result)
+            print_result(result)
+            count += 1
+            outputs += len(result["outputs"])
+            if not result["error"]:
+                images += 1
+                megapixels += result["megapixels"]
+    finally:
+        log.close()
+    print("Errors", count - images, "invalid job specs", len(invalid), "logged to", log.path)
+    print_summary(summarize_counts(count, images, outputs, megapixels, time.perf_counter() - start))
+
 
-    return error_items
+def run_storage(args):
+    # --input and/or --output is a storage location (s3://bucket/prefix, memory://directory). the next inputs are read
+    # while the current ones render and the outputs are uploaded in the background, output keys keep the local file names
+    source, target = open_storage(args.input), open_storage(args.output)
+    keys = source.list()
+    print("Initial Input Size", len(keys))
+    jobs = []
+    for key in keys:
+        job = build_job(key, args)
+        job["output_dir"] = ""
+        jobs.append(job)
+
+    start = time.perf_counter()
+    count, images, outputs, megapixels = 0, 0, 0, 0.0
+    for result in iter_storage_batch(jobs, source, target, args.workers, args.prefetch, args.upload_workers, chunk_size=args.chunk_size,
+                                     max_in_flight=args.max_in_flight, memory_budget=args.memory_budget * 1024 * 1024 if args.memory_budget else None):
+        print_result(result)
+        count += 1
+        outputs += len(result["outputs"])
+        if not result["error"]:
+            images += 1
+            megapixels += result["megapixels"]
+    print("Errors", count - images)
+    print_summary(summarize_counts(count, images, outputs, megapixels, time.perf_counter() - start))
+
+
+def watch(args):
+    # daemon mode: the worker pool, fonts and settings stay loaded and every file dropped into the input folder is rendered
+    cache = RenderCache(args.output, invalidate_on_settings_change=not args.keep_cache_on_settings_change) if args.cache else None
+    # keyed by job id, a file settled again while its first job still runs gets a job of its own
+    jobs = dict()
+    job_ids = itertools.count()
+
+    def make_job(image):
+        job = build_job(image, args)
+        if cache and cache.is_fresh(job):
+            return None
+        job["id"] = next(job_ids)
+        jobs[job["id"]] = job
+        return job
+
+    latencies = []
+    print("Watching", args.input)
+    try:
+        for result in iter_watch(args.input, make_job, args.workers, args.max_in_flight, args.settle_seconds, args.poll_interval, not args.polling):
+            print_watch_result(result)
+            latencies.append(result["latency"])
+            job = jobs.pop(result["id"])
+            if cache:
+                cache.record(job, result)
+                cache.save()
+    except KeyboardInterrupt:
+        pass
+    if latencies:
+        print("Rendered {0} files, latency p50 {1:.2f}s p90 {2:.2f}s max {3:.2f}s".format(len(latencies), percentile(latencies, 0.5), percentile(latencies, 0.9), max(latencies)))
 
 
 if __name__ == "__main__":
 
-    values = ["./input/" + item for item in os.listdir("./input")]
+    parser = argparse.ArgumentParser(description="Generate polaroids for every image in the input folder")
+    parser.add_argument("--input", default="./input")
+    parser.add_argument("--output", default="./output")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=1)
+    parser.add_argument("--max-in-flight", type=int, default=None)
+    parser.add_argument("--memory-budget", type=int, default=None, help="MB the running jobs may use together, larger jobs wait")
+    parser.add_argument("--stream-above", type=float, default=None, help="MP from which images are streamed to disk instead of rendered in memory")
+    parser.add_argument("--max-output-size", type=int, default=None, help="Long edge in px of the output, the source is decoded at reduced scale")
+    parser.add_argument("--format", default="png", choices=sorted(ENCODER_DEFAULTS))
+    parser.add_argument("--quality", type=int, default=None, help="JPEG/WebP quality")
+    parser.add_argument("--sizes", nargs="+", type=parse_output_size, default=None, metavar="NAME:PX[:FORMAT]",
+                        help="Extra outputs reduced from the same render, e.g. web:2048 thumb:400:jpeg, written with a _NAME suffix")
+    # box stays out of the choices, it is slower than gaussian for the same result (see Benchmark.py --blur-engines)
+    parser.add_argument("--blur-engine", default="pyramid", choices=sorted(engine for engine in BLUR_ENGINES if engine != "box"))
+    parser.add_argument("--pipeline", action="store_true", help="Run decode, render and encode as threaded stages in this process")
+    parser.add_argument("--decode-workers", type=int, default=1)
+    parser.add_argument("--render-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--encode-workers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=4)
+    parser.add_argument("--cache", action="store_true", help="Skip images whose outputs are already rendered and unchanged")
+    parser.add_argument("--clear-cache", action="store_true")
+    parser.add_argument("--keep-cache-on-settings-change", action="store_true", help="Do not invalidate the cache when ImageFactor values change")
+    parser.add_argument("--cache-max-mb", type=int, default=None)
+    parser.add_argument("--cache-max-age-days", type=float, default=None)
+    parser.add_argument("--order", default=None, choices=sorted(JOB_ORDERS), help="Read every header first and plan the batch in this order")
+    parser.add_argument("--stage-stats", action="store_true", help="Print per stage percentiles across the batch")
+    parser.add_argument("--trace", default=None, help="Append every stage timing to this JSONL file")
+    parser.add_argument("--watch", action="store_true", help="Keep running and render every file that lands in the input folder")
+    parser.add_argument("--settle-seconds", type=float, default=1.0, help="Watch mode: a file is read once its size has not changed for this long")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Watch mode: seconds between directory scans without inotify")
+    parser.add_argument("--polling", action="store_true", help="Watch mode: scan the directory instead of using inotify")
+    parser.add_argument("--jobs", default=None, help="JSONL file with one {image, type, color, output} per line instead of the input folder")
+    parser.add_argument("--result-log", default=None, help="JSONL log of finished jobs, defaults to JOBS.results.jsonl, completed jobs in it are skipped")
+    parser.add_argument("--prefetch", type=int, default=4, help="Storage mode: inputs read ahead while the current ones render")
+    parser.add_argument("--upload-workers", type=int, default=4, help="Storage mode: outputs uploaded at once")
+    args = parser.parse_args()
+
+    if args.watch:
+        watch(args)
+        raise SystemExit()
+    if args.jobs:
+        run_job_file(args)
+        raise SystemExit()
+    if is_storage_url(args.input) or is_storage_url(args.output):
+        run_storage(args)
+        raise SystemExit()
+
+    values = [os.path.join(args.input, item) for item in os.listdir(args.input)]
     print("Initial Input Size", len(values))
 
     data = []
     print("Preparing data")
     for image in values:
-        for color in ColorMode:
-            data.append({"image": image, "color": color, "type": PolaroidMode.INSTA_SQUARED_COMPACT})
+        data.append(build_job(image, args))
+
+    if args.order:
+        index = build_metadata_index(values)
+        print("Indexed", len(index), "headers,", sum(1 for header in index.values() if header and header["is_portrait"]), "portrait")
+        data = order_jobs(data, index, args.order)
+
+    cache = None
+    on_result = print_result
+    if args.cache:
+        cache = RenderCache(args.output, invalidate_on_settings_change=not args.keep_cache_on_settings_change)
+        if args.clear_cache:
+            cache.invalidate()
+        jobs = {job["image"]: job for job in data}
+        data = [job for job in data if not cache.is_fresh(job)]
+        print("Cache hits", cache.hits, "to render", len(data))
+
+        def on_result(result):
+            cache.record(jobs[result["image"]], result)
+            print_result(result)
+
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+    stage_timings = []
+    if args.pipeline:
+        # the pipeline runs in this process, so its stages report to a sink installed here
+        sink = CollectingSink(track_memory=bool(args.trace)) if args.stage_stats or args.trace else None
+        set_sink(sink)
+        results, summary = run_pipeline(data, args.decode_workers, args.render_workers, args.encode_workers, args.queue_size, on_result=on_result,
+                                        memory_budget=memory_budget)
+        set_sink(None)
+        if sink:
+            stage_timings = sink.get_stage_timings()
+            if args.trace:
+                trace = JsonlSink(args.trace)
+                for event in sink.events:
+                    trace.record(event)
+    else:
+        results, summary = run_batch(data, args.workers, args.chunk_size, args.max_in_flight, on_result=on_result, memory_budget=memory_budget)
+        stage_timings = [timing for result in results for timing in result.get("stages", [])]
 
+    if args.stage_stats:
+        print("{0:<16}{1:>8}{2:>10}{3:>10}{4:>10}{5:>10}".format("stage", "count", "total s", "p50 ms", "p90 ms", "p99 ms"))
+        for name, stats in sorted(aggregate_stage_timings(stage_timings).items(), key=lambda item: -item[1]["total"]):
+            print("{0:<16}{1:>8}{2:>10.2f}{3:>10.1f}{4:>10.1f}{5:>10.1f}".format(name, stats["count"], stats["total"], stats["p50"]*1000, stats["p90"]*1000, stats["p99"]*1000))
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as exe:
-        exe.map(main, data)
+    if cache:
+        max_bytes = args.cache_max_mb * 1024 * 1024 if args.cache_max_mb else None
+        max_age = args.cache_max_age_days * 86400 if args.cache_max_age_days else None
+        if max_bytes or max_age:
+            print("Evicted", cache.evict(max_bytes, max_age), "cached outputs")
+        cache.save()
 
-    print("final error Size", len(error_items), error_items)
\ No newline at end of file
+    error_items = [result for result in results if result["error"]]
+    print("final error Size", len(error_items), [item["image"] for item in error_items])
+    print_summary(summary)
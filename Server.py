@@ -0,0 +1,273 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import time
+import traceback
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+
+from PIL import Image, UnidentifiedImageError
+
+from Encoders import get_encoder
+from Instrumentation import stage
+from PolaroidBuilder import PolaroidSource, render_polaroid, warm_up
+from PolaroidSettings import color_mode_code, polaroid_mode_codes
+
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+MAX_HEADER_BYTES = 64 * 1024
+# Encoded output is written to the socket in chunks of this size, each one waits for the client to drain
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+class WorkerLost(Exception):
+    # the render's worker process died (e.g. killed for memory), the pool has been replaced
+    pass
+
+
+class BadRequest(Exception):
+    def __init__(self, status:int, message:str):
+        super().__init__(message)
+        self.status = status
+
+
+def render_upload(data:bytes, polaroid_type, color_mode, format:str, encoder_settings:dict, max_output_size:int = None) -> bytes:
+    # runs in a worker process, the upload is decoded, rendered and encoded there and only bytes cross the pipe
+    encoder = get_encoder(format, **encoder_settings)
+    with Image.open(io.BytesIO(data)) as im:
+        source = PolaroidSource(im, max_output_size, [polaroid_type], draft=True)
+    output_image = render_polaroid(source, polaroid_type, color_mode)
+    buffer = io.BytesIO()
+    with stage("encode", format=encoder.format):
+        encoder.encode(output_image, buffer)
+    return buffer.getvalue()
+
+
+class RenderService:
+    # at most max_concurrent renders run on the pool, max_queue more wait for a slot, anything beyond is rejected with 503
+    def __init__(self, workers:int = None, max_concurrent:int = None, max_queue:int = 16, queue_timeout:float = 30.0, max_upload_bytes:int = MAX_UPLOAD_BYTES):
+        self.workers = workers or os.cpu_count()
+        self.max_concurrent = max_concurrent or self.workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_upload_bytes = max_upload_bytes
+        self.executor = ProcessPoolExecutor(self.workers, initializer=warm_up)
+        self.slots = None
+        self.admitted = 0
+        self.active = 0
+        self.served = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def reserve(self) -> bool:
+        # counted from the request headers on, so uploads still being read take their place in the queue
+        if self.admitted >= self.max_concurrent + self.max_queue:
+            self.rejected += 1
+            return False
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.admitted -= 1
+
+    async def render(self, data:bytes, *args) -> bytes:
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_concurrent)
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise ServiceBusy()
+        self.active += 1
+        executor = self.executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, render_upload, data, *args)
+        except BrokenProcessPool:
+            # every request on the broken pool fails, only the first one replaces it
+            if executor is self.executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = ProcessPoolExecutor(self.workers, initializer=warm_up)
+            raise WorkerLost()
+        finally:
+            self.active -= 1
+            self.slots.release()
+
+    def get_stats(self) -> dict:
+        return {"workers": self.workers, "max_concurrent": self.max_concurrent, "max_queue": self.max_queue, "active": self.active,
+                "queued": self.admitted - self.active, "served": self.served, "rejected": self.rejected, "failed": self.failed}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def read_request_head(reader:asyncio.StreamReader):
+    # a head longer than the reader's limit (MAX_HEADER_BYTES) raises LimitOverrunError, answered with 431 by the handler
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, _ = lines[0].split(" ", 2)
+    except ValueError:
+        raise BadRequest(400, "Malformed request line")
+    headers = dict()
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    url = urllib.parse.urlsplit(target)
+    return method, url.path, dict(urllib.parse.parse_qsl(url.query)), headers
+
+
+async def write_head(writer:asyncio.StreamWriter, status:int, headers:dict):
+    lines = ["HTTP/1.1 {0} {1}".format(status, HTTPStatus(status).phrase)] + ["{0}: {1}".format(name, value) for name, value in headers.items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    await writer.drain()
+
+
+async def send_response(writer:asyncio.StreamWriter, status:int, body:bytes, content_type:str = "application/json", headers:dict = None):
+    await write_head(writer, status, dict({"Content-Type": content_type, "Content-Length": len(body), "Connection": "close"}, **(headers or {})))
+    writer.write(body)
+    await writer.drain()
+
+
+async def send_json(writer:asyncio.StreamWriter, status:int, value:dict, headers:dict = None):
+    await send_response(writer, status, json.dumps(value).encode(), headers=headers)
+
+
+async def send_streamed(writer:asyncio.StreamWriter, data:bytes, content_type:str, headers:dict = None):
+    # chunked transfer so the client starts receiving before the whole file is written, drain() applies the socket backpressure
+    await write_head(writer, 200, dict({"Content-Type": content_type, "Transfer-Encoding": "chunked", "Connection": "close"}, **(headers or {})))
+    view = memoryview(data)
+    for offset in range(0, len(view), STREAM_CHUNK_SIZE):
+        chunk = view[offset:offset + STREAM_CHUNK_SIZE]
+        writer.write(b"%x\r\n" % len(chunk))
+        writer.write(chunk)
+        writer.write(b"\r\n")
+        await writer.drain()
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+def parse_render_query(query:dict):
+    polaroid_type = polaroid_mode_codes.get(query.get("mode", "ISC"))
+    if polaroid_type is None:
+        raise BadRequest(400, "Unknown mode, expected one of " + ", ".join(polaroid_mode_codes))
+    color_mode = color_mode_code.get(query.get("color", "Dark"))
+    if color_mode is None:
+        raise BadRequest(400, "Unknown color, expected one of " + ", ".join(color_mode_code))
+    encoder_settings = dict()
+    try:
+        if "quality" in query:
+            encoder_settings["quality"] = int(query["quality"])
+        max_output_size = int(query["max_size"]) if "max_size" in query else None
+    except ValueError:
+        raise BadRequest(400, "quality and max_size must be integers")
+    if max_output_size is not None and max_output_size < 1:
+        raise BadRequest(400, "max_size must be positive")
+    try:
+        encoder = get_encoder(query.get("format", "png"), **encoder_settings)
+    except ValueError as e:
+        raise BadRequest(400, str(e))
+    return polaroid_type, color_mode, query.get("format", "png"), encoder_settings, max_output_size, encoder.mime_type
+
+
+async def handle_render(service:RenderService, reader:asyncio.StreamReader, writer:asyncio.StreamWriter, query:dict, headers:dict):
+    polaroid_type, color_mode, format, encoder_settings, max_output_size, mime_type = parse_render_query(query)
+    if "content-length" not in headers:
+        raise BadRequest(411, "Content-Length required")
+    # digits only, int() would also take signs, spaces and underscores
+    if not (headers["content-length"].isascii() and headers["content-length"].isdigit()):
+        raise BadRequest(400, "Content-Length must be a non-negative integer")
+    length = int(headers["content-length"])
+    if length > service.max_upload_bytes:
+        raise BadRequest(413, "Upload larger than {0} bytes".format(service.max_upload_bytes))
+
+    # rejected before the upload is read, a client sending Expect: 100-continue never transfers the body
+    if not service.reserve():
+        await send_json(writer, 503, {"error": "busy"}, {"Retry-After": 1})
+        return
+    try:
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
+        data = await reader.readexactly(length)
+        start = time.perf_counter()
+        try:
+            output = await service.render(data, polaroid_type, color_mode, format, encoder_settings, max_output_size)
+        except ServiceBusy:
+            await send_json(writer, 503, {"error": "queue timeout"}, {"Retry-After": 1})
+            return
+        except WorkerLost:
+            service.failed += 1
+            await send_json(writer, 503, {"error": "worker lost"}, {"Retry-After": 1})
+            return
+        except UnidentifiedImageError:
+            service.failed += 1
+            raise BadRequest(415, "Upload is not a supported image")
+        except Exception as e:
+            service.failed += 1
+            traceback.print_exc()
+            await send_json(writer, 500, {"error": repr(e)})
+            return
+        service.served += 1
+        await send_streamed(writer, output, mime_type, {"X-Render-Seconds": "{0:.3f}".format(time.perf_counter() - start)})
+    finally:
+        service.release()
+
+
+def make_handler(service:RenderService):
+    async def handle(reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        try:
+            method, path, query, headers = await read_request_head(reader)
+            if method == "POST" and path == "/render":
+                await handle_render(service, reader, writer, query, headers)
+            elif method == "GET" and path == "/health":
+                await send_json(writer, 200, service.get_stats())
+            else:
+                await send_json(writer, 404, {"error": "not found"})
+        except BadRequest as e:
+            await send_json(writer, e.status, {"error": str(e)})
+        except asyncio.LimitOverrunError:
+            try:
+                await send_json(writer, 431, {"error": "Request header too large"})
+            except ConnectionError:
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # the client went away or sent a broken request, nothing left to answer
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+async def serve(host:str, port:int, service:RenderService):
+    server = await asyncio.start_server(make_handler(service), host, port, limit=MAX_HEADER_BYTES)
+    print("Serving on", ", ".join(str(socket.getsockname()) for socket in server.sockets))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP render service, POST an image to /render?mode=ISC&color=Dark&format=png")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--max-concurrent", type=int, default=None, help="Renders running at once, defaults to the workers")
+    parser.add_argument("--max-queue", type=int, default=16, help="Requests waiting for a render slot before new ones get 503")
+    parser.add_argument("--queue-timeout", type=float, default=30.0, help="Seconds a request may wait for a slot")
+    parser.add_argument("--max-upload-mb", type=int, default=MAX_UPLOAD_BYTES // (1024 * 1024))
+    args = parser.parse_args()
+
+    service = RenderService(args.workers, args.max_concurrent, args.max_queue, args.queue_timeout, args.max_upload_mb * 1024 * 1024)
+    try:
+        asyncio.run(serve(args.host, args.port, service))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.shutdown()
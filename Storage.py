@@ -0,0 +1,199 @@
+import collections
+import concurrent.futures
+import mimetypes
+import os
+import threading
+import time
+import traceback
+
+from BatchEngine import iter_batch
+
+# Locations with a scheme go through a storage backend, anything else is a local directory
+STORAGE_SCHEMES = ("s3://", "memory://")
+PREFETCH = 4
+UPLOAD_WORKERS = 4
+# Encoded outputs held while they wait for an upload slot, the pool results block once this many are queued
+MAX_PENDING_UPLOADS = 16
+
+
+class LocalStorage:
+    # a directory on disk, keys are "/" separated paths relative to it
+    def __init__(self, root:str):
+        self.root = root
+
+    def list(self, prefix:str = "") -> list:
+        keys = []
+        for directory, folders, files in os.walk(self.root):
+            folders[:] = [folder for folder in folders if not folder.startswith(".")]
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, "/")
+                if not name.startswith(".") and key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def read(self, key:str) -> bytes:
+        with open(os.path.join(self.root, key), "rb") as fp:
+            return fp.read()
+
+    def write(self, key:str, data:bytes):
+        # through a temporary file, a reader never sees half an output
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(data)
+        os.replace(path + ".tmp", path)
+
+
+class MemoryStorage:
+    # stand-in for tests and dry runs, the objects live in a dict. from_directory starts it with a copy of local files,
+    # and latency (seconds per call) makes it behave like a remote store
+    def __init__(self, objects:dict = None, latency:float = 0.0):
+        self.objects = dict(objects or {})
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_directory(cls, root:str, latency:float = 0.0):
+        local = LocalStorage(root)
+        return cls({key: local.read(key) for key in local.list()}, latency)
+
+    def list(self, prefix:str = "") -> list:
+        with self.lock:
+            return sorted(key for key in self.objects if key.startswith(prefix))
+
+    def read(self, key:str) -> bytes:
+        time.sleep(self.latency)
+        with self.lock:
+            if key not in self.objects:
+                raise FileNotFoundError(key)
+            return self.objects[key]
+
+    def write(self, key:str, data:bytes):
+        time.sleep(self.latency)
+        with self.lock:
+            self.objects[key] = bytes(data)
+
+
+class S3Storage:
+    # any S3 compatible store (the bucket of template.yaml, MinIO, ...), keys are relative to prefix.
+    # boto3 is optional and only imported here, its clients are safe to share between the prefetch and upload threads
+    def __init__(self, bucket:str, prefix:str = "", endpoint_url:str = None, client=None):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise ImportError("s3:// locations need boto3, pip install boto3")
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+
+    def list(self, prefix:str = "") -> list:
+        keys = []
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            keys += [item["Key"][len(self.prefix):] for item in page.get("Contents", []) if not item["Key"].endswith("/")]
+        return sorted(keys)
+
+    def read(self, key:str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)["Body"].read()
+
+    def write(self, key:str, data:bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data,
+                               ContentType=mimetypes.guess_type(key)[0] or "application/octet-stream")
+
+
+def is_storage_url(location:str) -> bool:
+    return location.startswith(STORAGE_SCHEMES)
+
+
+def open_storage(location:str):
+    # s3://bucket/prefix (endpoint from AWS_ENDPOINT_URL), memory://directory (copied into memory), or a local directory
+    if location.startswith("s3://"):
+        bucket, _, prefix = location[len("s3://"):].partition("/")
+        return S3Storage(bucket, prefix, os.environ.get("AWS_ENDPOINT_URL"))
+    if location.startswith("memory://"):
+        root = location[len("memory://"):]
+        return MemoryStorage.from_directory(root) if root else MemoryStorage()
+    return LocalStorage(location)
+
+
+def iter_prefetched(storage, jobs, prefetch:int = PREFETCH):
+    # yields (job, bytes or the read exception) in job order, the next prefetch inputs are read on threads meanwhile
+    with concurrent.futures.ThreadPoolExecutor(max(1, prefetch)) as executor:
+        pending = collections.deque()
+
+        def take():
+            job, future = pending.popleft()
+            try:
+                return job, future.result()
+            except Exception as e:
+                return job, e
+
+        for job in jobs:
+            pending.append((job, executor.submit(storage.read, job["image"])))
+            if len(pending) > prefetch:
+                yield take()
+        while pending:
+            yield take()
+
+
+class AsyncUploader:
+    # writes to storage on a thread pool so uploads overlap with rendering. at most max_pending outputs wait for
+    # a thread, submit blocks beyond that, which holds the batch back instead of buffering a slow store in memory
+    def __init__(self, storage, workers:int = UPLOAD_WORKERS, max_pending:int = MAX_PENDING_UPLOADS):
+        self.storage = storage
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.slots = threading.BoundedSemaphore(max(workers, max_pending))
+
+    def submit(self, key:str, data:bytes) -> concurrent.futures.Future:
+        self.slots.acquire()
+        future = self.executor.submit(self.storage.write, key, data)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def finish_upload(result:dict, futures:list) -> dict:
+    for future in futures:
+        error = future.exception()
+        if error is not None and not result["error"]:
+            result["error"] = "Upload failed: " + repr(error)
+            result["traceback"] = "".join(traceback.format_exception(error))
+    return result
+
+
+def iter_storage_batch(jobs, source, target, workers:int = None, prefetch:int = PREFETCH, upload_workers:int = UPLOAD_WORKERS, **batch_options):
+    # jobs name keys in source, their output paths (output_dir "" keeps them relative) become keys in target.
+    # inputs are prefetched while the process pool renders, the workers return encoded bytes instead of writing files
+    # and uploads run in the background. a result is yielded once all of its uploads finished, batch_options go to iter_batch
+    failed = collections.deque()
+
+    def read_jobs():
+        for job, data in iter_prefetched(source, jobs, prefetch):
+            if isinstance(data, Exception):
+                result = {"image": job["image"], "outputs": [], "megapixels": 0.0, "seconds": 0.0, "error": "Read failed: " + repr(data)}
+                if "id" in job:
+                    result["id"] = job["id"]
+                failed.append(result)
+            else:
+                yield dict(job, data=data, return_encoded=True)
+
+    uploader = AsyncUploader(target, upload_workers)
+    uploading = []
+    try:
+        for result in iter_batch(read_jobs(), workers, **batch_options):
+            uploading.append((result, [uploader.submit(key, data) for key, data in result.pop("encoded", {}).items()]))
+            while failed:
+                yield failed.popleft()
+            for item in [item for item in uploading if all(future.done() for future in item[1])]:
+                uploading.remove(item)
+                yield finish_upload(*item)
+        while failed:
+            yield failed.popleft()
+        for result, futures in uploading:
+            concurrent.futures.wait(futures)
+            yield finish_upload(result, futures)
+    finally:
+        uploader.close()
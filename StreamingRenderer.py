@@ -0,0 +1,71 @@
+import struct
+import zlib
+
+from PIL import Image
+
+from PolaroidBuilder import PolaroidSource, get_layout, compose_rows
+from PolaroidSettings import PolaroidMode, ColorMode
+
+# Canvas rows composed and encoded at a time, peak memory is about one strip of the output
+STREAM_STRIP_HEIGHT = 256
+PNG_COLOR_TYPES = {"L": 0, "RGB": 2, "LA": 4, "RGBA": 6}
+PNG_BITS_PER_CHANNEL = 8
+
+
+class PngStreamWriter:
+    # writes a PNG row strip by row strip, the whole image is never held in memory
+    def __init__(self, fp, size:tuple, mode:str, compress_level:int = 1):
+        if mode not in PNG_COLOR_TYPES:
+            raise ValueError("Streaming PNG output does not support mode " + mode)
+        self.fp = fp
+        self.size = size
+        self.mode = mode
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(compress_level)
+        fp.write(b"\x89PNG\r\n\x1a\n")
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], PNG_BITS_PER_CHANNEL, PNG_COLOR_TYPES[mode], 0, 0, 0))
+
+    def write_chunk(self, chunk_type:bytes, data:bytes):
+        self.fp.write(struct.pack(">I", len(data)) + chunk_type + data)
+        self.fp.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    def write_rows(self, strip:Image.Image):
+        raw = strip.tobytes()
+        stride = len(raw) // strip.height
+        # every scanline starts with filter type 0 (none)
+        rows = b"".join(b"\x00" + raw[row*stride:(row+1)*stride] for row in range(strip.height))
+        data = self.compressor.compress(rows)
+        if data:
+            self.write_chunk(b"IDAT", data)
+        self.rows_written += strip.height
+
+    def close(self):
+        if self.rows_written != self.size[1]:
+            raise ValueError("Expected " + str(self.size[1]) + " rows, got " + str(self.rows_written))
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+
+
+#@profile
+def write_polaroid_streamed(source:PolaroidSource, polaroid_type:PolaroidMode, color_mode:ColorMode, fp, blur_engine:str = "pyramid",
+                            strip_height:int = STREAM_STRIP_HEIGHT, compress_level:int = 1) -> tuple:
+    # same layout as render_polaroid, but the canvas is composed strip by strip straight into the PNG encoder
+    plan = get_layout(source, polaroid_type)
+    width, height = plan.canvas_size
+    writer = PngStreamWriter(fp, (width, height), source.image.mode, compress_level)
+    for top in range(0, height, strip_height):
+        strip = Image.new(source.image.mode, (width, min(strip_height, height - top)), color_mode.value.background_color)
+        compose_rows(strip, top, source, plan, color_mode, blur_engine)
+        writer.write_rows(strip)
+    writer.close()
+    return width, height
+
+
+def render_polaroid_streamed(im:Image.Image, polaroid_type:PolaroidMode, color_mode:ColorMode, fp, blur_engine:str = "pyramid",
+                             strip_height:int = STREAM_STRIP_HEIGHT, compress_level:int = 1) -> tuple:
+    return write_polaroid_streamed(PolaroidSource(im), polaroid_type, color_mode, fp, blur_engine, strip_height, compress_level)
+
+
+def generate_polaroid_streamed_from_url(image_url:str, polaroid_type:PolaroidMode, color_mode:ColorMode, output_path:str, blur_engine:str = "pyramid") -> tuple:
+    with Image.open(image_url) as im, open(output_path, "wb") as fp:
+        return render_polaroid_streamed(im, polaroid_type, color_mode, fp, blur_engine)
@@ -0,0 +1,206 @@
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import struct
+import sys
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+from BatchEngine import render_job
+
+# inotify(7) flags, a file is a candidate once its writer closed it or it was moved in
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+INOTIFY_READ_SIZE = 64 * 1024
+# Seconds between checks of running jobs and settling files while the daemon is busy
+WATCH_TICK = 0.1
+# Names of files still being written by common tools
+PARTIAL_SUFFIXES = (".part", ".tmp", ".crdownload", ".download")
+
+
+def is_candidate(name:str) -> bool:
+    return not name.startswith(".") and not name.endswith(PARTIAL_SUFFIXES)
+
+
+def list_candidates(directory:str) -> list:
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if is_candidate(name)]
+
+
+class InotifyWatcher:
+    # Linux only, reads close/move events from the kernel through libc, so an idle daemon costs nothing
+    def __init__(self, directory:str):
+        self.directory = directory
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for " + directory)
+
+    def poll(self, timeout:float) -> list:
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, INOTIFY_READ_SIZE)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped, fall back to a full listing once
+                return list_candidates(self.directory)
+            if name and is_candidate(name):
+                paths.append(os.path.join(self.directory, name))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    # portable fallback, rescans the directory every interval and reports new or modified files
+    def __init__(self, directory:str, interval:float = 1.0):
+        self.directory = directory
+        self.interval = interval
+        self.known = dict()
+        self.next_scan = 0.0
+        self.scan()
+
+    def scan(self) -> list:
+        self.next_scan = time.monotonic() + self.interval
+        changed = []
+        current = dict()
+        for path in list_candidates(self.directory):
+            try:
+                current[path] = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if self.known.get(path) != current[path]:
+                changed.append(path)
+        self.known = current
+        return changed
+
+    def poll(self, timeout:float) -> list:
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0.0, wait))
+        return self.scan()
+
+    def close(self):
+        pass
+
+
+def open_watcher(directory:str, poll_interval:float = 1.0, use_inotify:bool = True):
+    if use_inotify and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError):
+            # no inotify symbols in this libc or the watch limit is reached
+            pass
+    return PollingWatcher(directory, poll_interval)
+
+
+class SettleTracker:
+    # a file is handed on once its size and mtime stayed the same for settle_seconds, so half-written uploads are not read
+    def __init__(self, settle_seconds:float = 1.0):
+        self.settle_seconds = settle_seconds
+        self.files = dict()
+
+    def __len__(self):
+        return len(self.files)
+
+    def add(self, path:str, now:float = None):
+        now = time.monotonic() if now is None else now
+        arrival = self.files[path][0] if path in self.files else now
+        self.files[path] = (arrival, None, now)
+
+    def pop_ready(self, now:float = None) -> list:
+        # [(path, arrival)] of the files that stopped changing
+        now = time.monotonic() if now is None else now
+        ready = []
+        for path, (arrival, signature, since) in list(self.files.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self.files[path]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != signature:
+                self.files[path] = (arrival, current, now)
+            elif now - since >= self.settle_seconds:
+                del self.files[path]
+                ready.append((path, arrival))
+        return ready
+
+
+def warm_worker():
+    # runs once per pool process, so the first job does not pay for the imports and the font files.
+    # Ctrl-C reaches the whole process group, the daemon shuts the pool down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from PolaroidBuilder import warm_up
+    warm_up()
+
+
+def iter_watch(directory:str, make_job, workers:int = None, max_in_flight:int = None, settle_seconds:float = 1.0, poll_interval:float = 1.0,
+               use_inotify:bool = True, include_existing:bool = True):
+    # runs until interrupted, yields one result per settled file with "latency" (seconds from arrival to output) and "queue_depth".
+    # make_job(path) returns the job dict, or None to skip the file
+    workers = workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * workers
+    watcher = open_watcher(directory, poll_interval, use_inotify)
+    settle = SettleTracker(settle_seconds)
+    if include_existing:
+        for path in list_candidates(directory):
+            settle.add(path)
+    queue = collections.deque()
+    pending = dict()
+    executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=warm_worker)
+    try:
+        while True:
+            busy = pending or queue or settle
+            for path in watcher.poll(WATCH_TICK if busy else poll_interval):
+                settle.add(path)
+            for path, arrival in settle.pop_ready():
+                job = make_job(path)
+                if job is not None:
+                    queue.append((job, arrival))
+
+            while queue and len(pending) < max_in_flight:
+                job, arrival = queue.popleft()
+                try:
+                    pending[executor.submit(render_job, job)] = (job, arrival)
+                except BrokenProcessPool:
+                    # a worker was killed (e.g. out of memory), start a fresh pool and keep the daemon alive
+                    queue.appendleft((job, arrival))
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=warm_worker)
+
+            for future in [future for future in pending if future.done()]:
+                job, arrival = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"image": job["image"], "outputs": [], "megapixels": 0.0, "seconds": 0.0, "error": repr(e)}
+                    if "id" in job:
+                        result["id"] = job["id"]
+                result["latency"] = time.monotonic() - arrival
+                result["queue_depth"] = len(settle) + len(queue) + len(pending)
+                yield result
+    finally:
+        watcher.close()
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -1,42 +1,31 @@
 import traceback
 
 from pyscript import document, window
-from pyodide.ffi import create_proxy
-from PIL import Image
-import io
-import base64
-from js import console, File, FileReader, Uint8Array
+from pyodide.ffi import create_proxy, to_js
+from js import console, Blob, Object, URL, Uint8Array
 import asyncio
 
-from PolaroidBuilder import generate_polaroid
-from PolaroidSettings import ColorMode, PolaroidMode
-
-polaroid_mode_codes = {
-    "F": PolaroidMode.FULL_POLAROID,
-    "H": PolaroidMode.HALF_POLAROID,
-    "Q": PolaroidMode.QUARTER_POLAROID,
-    "IS": PolaroidMode.INSTA_SQUARED,
-    "FC": PolaroidMode.FULL_POLAROID_COMPACT,
-    "HC": PolaroidMode.HALF_POLAROID_COMPACT,
-    "QC": PolaroidMode.QUARTER_POLAROID_COMPACT,
-    "ISC": PolaroidMode.INSTA_SQUARED_COMPACT,
-}
-
-color_mode_code ={
-    "Dark": ColorMode.DARK,
-    "Light": ColorMode.LIGHT
-}
+from ImageCodec import image_to_bytes
+from PolaroidBuilder import render_batch, warm_up
+from PolaroidSettings import color_mode_code, polaroid_mode_codes
 
 submit_btn = document.getElementById("submitBtn")
 results_section = document.getElementById('resultsSection')
 download_all_btn = document.getElementById("downloadAll")
+# Long edge in px of the result card previews, the full resolution render only happens on download
+PREVIEW_SIZE = 1024
 
 class ImageProcessor:
     def __init__(self):
+        # fonts, image plugins and date parsing are loaded while the loading screen still shows. the previews are
+        # rendered at reduced sizes, so there are no common layout plans to build
+        warm_up(photo_sizes=())
         self.images = []
         self.proxies = []  # Store proxies to prevent garbage collection
         self.setup_event_listeners()
         self.list_of_downloads = []
+        self.object_urls = []
+        self.full_renders = {}  # (File, polaroid mode, color mode) -> task resolving to an object URL
 
     def setup_event_listeners(self):
         """Setup all event listeners"""
@@ -60,48 +49,27 @@ class ImageProcessor:
         document.getElementById("polaroidAccordion").classList.remove('d-none')
 
     async def handle_image_upload(self, event):
-        """Handle image upload and display preview"""
+        """Handle image upload, files are only read when they are rendered"""
         files = event.target.files
 
-        # Clear previous previews and images
+        # Clear previous images
         self.images = []
-        crt = 0
-        # Process each file
         for i in range(files.length):
-            if i < 10:
-                file = files.item(i)
-
-                # Read file as data URL
-                reader = FileReader.new()
-
-                # Create a promise to wait for file reading
-                promise = self.read_file_as_data_url(reader, file)
-                data_url = await promise
-
-                # Store original image data
-                self.images.append({
-                    'data_url': data_url,
-                    'name': file.name
-                })
-            crt+=1
-        if crt > 10:
-            window.alert("More than 10 images are selected. Only first 10 will be processed!")
-
-    async def read_file_as_data_url(self, reader, file):
-        """Read file as data URL using promise"""
-        future = asyncio.Future()
-
-        def on_load(event):
-            future.set_result(reader.result)
-
-        # Create proxy for the callback
-        load_proxy = create_proxy(on_load)
-        reader.addEventListener("load", load_proxy)
-        reader.readAsDataURL(file)
-
-        result = await future
-        load_proxy.destroy()  # Clean up the proxy after use
-        return result
+            file = files.item(i)
+            self.images.append({
+                'file': file,
+                'name': file.name
+            })
+
+    async def read_upload(self, file):
+        """Raw bytes of one upload"""
+        buffer = await file.arrayBuffer()
+        return Uint8Array.new(buffer).to_bytes()
+
+    async def read_uploads(self, uploads):
+        """Raw bytes of each upload, read one at a time as the batch reaches it"""
+        for img_data in uploads:
+            yield await self.read_upload(img_data['file'])
 
     async def process_images(self, event):
         # Add Loading animation
@@ -121,38 +89,44 @@ class ImageProcessor:
         # Process images
         results_container = document.getElementById("resultsContainer")
 
-        await asyncio.sleep(0.1)  # Allow UI to update
-        
         # Generate Result Table
         results_container.innerHTML = ''
         self.list_of_downloads= []
-        for idx, img_data in enumerate(self.images):
+        color_mode = color_mode_code.get(color_type)
+        polaroid_mode = polaroid_mode_codes.get(polaroid_type)
+        self.set_progress(0)
+        # render_batch hands control back to the browser between stages, so the page repaints without fixed sleeps
+        self.revoke_object_urls()
+        # previews keep the layout of the selected mode at PREVIEW_SIZE, an unreadable upload fails only its own result.
+        # the batch keeps its own list, a new selection made meanwhile does not shift the indexes
+        uploads = list(self.images)
+        async for result in render_batch(self.read_uploads(uploads), polaroid_mode, color_mode, max_output_size=PREVIEW_SIZE):
+            idx = result["index"]
+            img_data = uploads[idx]
             try:
-                submit_btn.innerHTML = '<span class="spinner-border spinner-border-sm me-2"></span>Creating...'+(str(idx+1))+"/"+(str(len(self.images)))
-                await asyncio.sleep(0.1)
-                # Convert data URL to PIL Image
-                pil_image = self.data_url_to_pil(img_data['data_url'])
-
-                color_mode = color_mode_code.get(color_type)
-                polaroid_mode = polaroid_mode_codes.get(polaroid_type)
+                if result["error"]:
+                    raise Exception(result["error"])
+                self.set_progress(idx + 1)
 
-                processed_image = generate_polaroid(pil_image, polaroid_mode, color_mode)
-                # Convert back to data URL
-                processed_data_url = self.pil_to_data_url(processed_image)
+                # Encoded bytes go straight into a Blob
+                encoded, mime_type = image_to_bytes(result["image"])
+                processed_url = self.bytes_to_object_url(encoded, mime_type)
+                del encoded
 
                 # Generate Card
                 resultCard = document.createElement('div')
                 resultCard.className = 'result-card'
                 resultCard.style.animationDelay = f"{idx * 0.1}s"
 
+                # the card downloads its own File, whatever has been uploaded since
                 download_proxy = create_proxy(
-                    lambda e, url=processed_data_url, name=img_data['name']: self.download_image(url, name,
-                                                                                                 polaroid_mode,
-                                                                                                 color_mode))
+                    lambda e, file=img_data['file'], name=img_data['name']: self.download_image(file, name,
+                                                                                                polaroid_mode,
+                                                                                                color_mode))
 
                 # Create main image element
                 img = document.createElement("img")
-                img.src = processed_data_url
+                img.src = processed_url
                 img.alt = f"Polaroid {idx + 1}"
                 img.className = "result-card-image"
 
@@ -214,7 +188,7 @@ class ImageProcessor:
                 download_btn.className = "btn btn-outline-primary"
                 download_btn.title = "Download"
                 download_btn.addEventListener("click", download_proxy)
-                self.list_of_downloads.append(download_btn)
+                self.list_of_downloads.append((img_data['file'], img_data['name'], polaroid_mode, color_mode))
 
                 # Create SVG for download icon
                 svg_ns = "http://www.w3.org/2000/svg"
@@ -266,39 +240,56 @@ class ImageProcessor:
         window.setTimeout(set_transition, 10)
 
 
-    def data_url_to_pil(self, data_url):
-        """Convert data URL to PIL Image"""
-        # Remove data URL prefix
-        header, encoded = data_url.split(',', 1)
-
-        # Decode base64
-        image_data = base64.b64decode(encoded)
-
-        # Convert to PIL Image
-        image = Image.open(io.BytesIO(image_data))
-        return image
-
-    def pil_to_data_url(self, image):
-        """Convert PIL Image to data URL"""
-        buffer = io.BytesIO()
-
-        image.save(buffer, format="PNG", compress_level=1)
-
-        # Get base64 encoded string
-        encoded = base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-        # Create data URL
-        mime_type = f"image/PNG"
-        data_url = f"data:{mime_type};base64,{encoded}"
-
-        return data_url
-
-
-    def download_image(self, data_url, original_name, polaroid_type, color_type):
+    def set_progress(self, done):
+        submit_btn.innerHTML = '<span class="spinner-border spinner-border-sm me-2"></span>Creating...'+(str(min(done + 1, len(self.images))))+"/"+(str(len(self.images)))
+
+    def bytes_to_object_url(self, data, mime_type):
+        """Copy encoded bytes into a Blob and return an object URL for it"""
+        js_array = Uint8Array.new(len(data))
+        js_array.assign(data)
+        blob = Blob.new(to_js([js_array]), to_js({"type": mime_type}, dict_converter=Object.fromEntries))
+        url = URL.createObjectURL(blob)
+        self.object_urls.append(url)
+        return url
+
+    def revoke_object_urls(self):
+        """Release the Blobs of the previous results"""
+        for url in self.object_urls:
+            URL.revokeObjectURL(url)
+        self.object_urls = []
+        self.full_renders = {}
+
+    async def render_full(self, file, polaroid_type, color_type):
+        """Full resolution render of one upload, returns its object URL"""
+        async for result in render_batch([await self.read_upload(file)], polaroid_type, color_type):
+            if result["error"]:
+                raise Exception(result["error"])
+            encoded, mime_type = image_to_bytes(result["image"])
+            return self.bytes_to_object_url(encoded, mime_type)
+
+    async def get_full_render(self, file, polaroid_type, color_type):
+        """Full resolution object URL, rendered on the first request and shared by every later one"""
+        key = (file, polaroid_type, color_type)
+        if key not in self.full_renders:
+            self.full_renders[key] = asyncio.ensure_future(self.render_full(file, polaroid_type, color_type))
+        try:
+            return await self.full_renders[key]
+        except Exception:
+            # let the next click try again
+            self.full_renders.pop(key, None)
+            raise
+
+    async def download_image(self, file, original_name, polaroid_type, color_type):
         """Download image when clicked"""
+        try:
+            url = await self.get_full_render(file, polaroid_type, color_type)
+        except Exception as e:
+            console.error(f"Error rendering image {original_name}: {str(e)}")
+            return
+
         # Create download link
         a = document.createElement("a")
-        a.href = data_url
+        a.href = url
 
         # Generate filename
         name_without_ext = original_name.rsplit('.', 1)[0] if '.' in original_name else original_name
@@ -308,8 +299,9 @@ class ImageProcessor:
         a.click()
 
     async def download_all(self, event):
-        for item in self.list_of_downloads:
-            item.click()
+        # one full resolution render at a time, they are the largest allocations of the page
+        for file, name, polaroid_type, color_type in self.list_of_downloads:
+            await self.download_image(file, name, polaroid_type, color_type)
 
 
 # Initialize the processor
@@ -62,7 +62,12 @@ function handleImageUpload(e) {
     handleMultipleFiles(files);
 }
 
+function revokeUploadedImages() {
+    appState.uploadedImages.forEach(imageData => URL.revokeObjectURL(imageData.src));
+}
+
 function handleMultipleFiles(files) {
+    revokeUploadedImages();
     appState.uploadedImages= [];
     galleryGrid.innerHTML = '';
     const validFiles = Array.from(files).filter(file => file.type.startsWith('image/'));
@@ -72,37 +77,24 @@ function handleMultipleFiles(files) {
         return;
     }
 
-    let crt =0
-
     validFiles.forEach(file => {
-
-        if(crt < 10){
-
-            const reader = new FileReader();
-
-            reader.onload = function(event) {
-                const imageData = {
-                    id: Date.now() + Math.random(), // Unique ID
-                    src: event.target.result,
-                    name: file.name
-                };
-
-                appState.uploadedImages.push(imageData);
-                addImageToGallery(imageData);
-                updateImageCount();
-
-                // Enable Step 2 if images exist
-                if (appState.uploadedImages.length > 0) {
-                    step2Button.removeAttribute('disabled');
-                }
-            };
-
-            reader.readAsDataURL(file);
-            crt++;
-        }
-
+        // the thumbnail points at the file itself, nothing is read or base64 encoded
+        const imageData = {
+            id: Date.now() + Math.random(), // Unique ID
+            src: URL.createObjectURL(file),
+            name: file.name
+        };
+
+        appState.uploadedImages.push(imageData);
+        addImageToGallery(imageData);
+        updateImageCount();
     });
 
+    // Enable Step 2 if images exist
+    if (appState.uploadedImages.length > 0) {
+        step2Button.removeAttribute('disabled');
+    }
+
     // Show gallery
     imageGallery.classList.remove('d-none');
 }
@@ -132,6 +124,7 @@ function updateImageCount() {
 // Clear all images
 clearAllBtn.addEventListener('click', function() {
     if (confirm(`Are you sure you want to remove all ${appState.uploadedImages.length} images?`)) {
+        revokeUploadedImages();
         appState.uploadedImages = [];
         galleryGrid.innerHTML = '';
         imageGallery.classList.add('d-none');